@@ -1,94 +1,359 @@
+import asyncio
+import json
 import os
-import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Request, Response
-from yandex_cloud_ml_sdk import YCloudML
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from yandex_cloud_ml_sdk import AsyncYCloudML
 
-from schemas.request import PredictionRequest, PredictionResponse
+# env должен быть загружен до импорта utils: модули читают настройки при импорте
+load_dotenv()
+
+from schemas.request import JobRequest, JobResponse, PredictionRequest, PredictionResponse
 from utils.LLM_solvers import YaGPTResponse
-from utils.exceptions import LLMWorkflowError
+from utils.access_log import AccessLogMiddleware, JsonLineWriter
+from utils.batch import BatchPlan, BATCH_CONCURRENCY, BATCH_MAX_SIZE
+from utils.cache import build_cache
+from utils.data_retrival_util import summary_cache
+from utils.deadline import Deadline
+from utils.exceptions import DeadlineExceeded, JobQueueFull, LLMWorkflowError, RateLimited
+from utils.jobs import Job, JobQueue, JobStore, JOBS_DEADLINE, JOBS_MAX_WAIT, JOBS_RETRY_AFTER
 from utils.logger import setup_logger
-
-# Initialize
-app = FastAPI()
-logger = setup_logger()
-
-load_dotenv()
+from utils.metrics import REGISTRY, gauge_lines
+from utils.questions import question_key, to_entry, from_entry
+from utils.rate_limit import limiter_stats
+from utils.resources import load_prompts, Resources
+from utils.singleflight import SingleFlight
+from utils.sse import (format_event, stage_event, wait_disconnect, wants_stream, PING, SSE_HEADERS, SSE_MEDIA_TYPE,
+                       SSE_PING_INTERVAL)
 
 catalogue_id = os.getenv("YA_CATALOG_ID")
 gpt_api_key = os.getenv("YA_GPT_KEY")
 search_api_key = os.getenv("YA_SEARCH_KEY")
+prompts = load_prompts()
 
 
-@app.on_event("startup")
-async def startup_event():
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ресурсы воркера создаются один раз здесь, а не на каждый запрос.
+    Под gunicorn --preload импорт main и чтение промптов происходят в
+    мастере, а lifespan - уже в каждом воркере после fork.
+    Готовые ресурсы в app.state.resources (например, с фейковым sdk) не пересоздаются
+    """
     global logger
     logger = await setup_logger()
+    access_log.start()
+    if getattr(app.state, "resources", None) is None:
+        app.state.resources = Resources(AsyncYCloudML(folder_id=catalogue_id, auth=gpt_api_key), search_api_key,
+                                       prompts=prompts)
+    await app.state.resources.start()
+    abandoned = await job_store.abandon_orphans()
+    if abandoned:
+        await logger.warning(f"Marked {abandoned} jobs of stopped workers as failed")
+    job_queue.start()
+    try:
+        yield
+    finally:
+        await job_queue.stop()
+        await access_log.stop()
+        await app.state.resources.close()
 
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    start_time = time.time()
+# Initialize
+app = FastAPI(lifespan=lifespan)
+logger = setup_logger()
+access_log = JsonLineWriter()
+app.add_middleware(AccessLogMiddleware, writer=access_log)
+
+answer_cache = build_cache("ANSWER_CACHE", maxsize=1024, ttl=24 * 3600, path="cache/answers.sqlite")
+in_flight = SingleFlight()
+job_store = JobStore()
+
 
-    body = await request.body()
-    await logger.info(
-        f"Incoming request: {request.method} {request.url}\n"
-        f"Request body: {body.decode()}"
+def collect_runtime_metrics():
+    caches = {"answers": answer_cache, "summaries": summary_cache}
+    limiters = limiter_stats()
+    return (
+        gauge_lines("cache_hits", "Cache hits since worker start", {(name,): cache.hits for name, cache in caches.items()},
+                    ["cache"])
+        + gauge_lines("cache_misses", "Cache misses since worker start",
+                      {(name,): cache.misses for name, cache in caches.items()}, ["cache"])
+        + gauge_lines("singleflight_coalesced", "Requests that joined an in-flight computation",
+                      {(): in_flight.coalesced})
+        + gauge_lines("rate_limit_window", "Current AIMD concurrency window",
+                      {(name,): stats["window"] for name, stats in limiters.items()}, ["api"])
+        + gauge_lines("rate_limit_queued", "Calls waiting for a rate limiter slot",
+                      {(name,): stats["queued"] for name, stats in limiters.items()}, ["api"])
+        + gauge_lines("rate_limit_throttled", "Throttling responses received",
+                      {(name,): stats["throttled"] for name, stats in limiters.items()}, ["api"])
+        + gauge_lines("jobs_queued", "Jobs waiting in the worker queue", {(): job_queue.stats()["queued"]})
+        + gauge_lines("jobs_running", "Jobs being solved by the worker", {(): job_queue.stats()["running"]})
+        + gauge_lines("access_log_dropped", "Access log records dropped because the queue was full",
+                      {(): access_log.dropped})
     )
 
-    response = await call_next(request)
-    process_time = time.time() - start_time
 
-    response_body = b""
-    async for chunk in response.body_iterator:
-        response_body += chunk
+REGISTRY.add_collector(collect_runtime_metrics)
 
-    await logger.info(
-        f"Request completed: {request.method} {request.url}\n"
-        f"Status: {response.status_code}\n"
-        f"Response body: {response_body.decode()}\n"
-        f"Duration: {process_time:.3f}s"
-    )
 
-    return Response(
-        content=response_body,
-        status_code=response.status_code,
-        headers=dict(response.headers),
-        media_type=response.media_type,
-    )
+def cache_bypassed(request: Request) -> bool:
+    """Клиент может попросить пересчитать ответ заголовком X-Cache-Bypass или Cache-Control: no-cache"""
+    return (request.headers.get("x-cache-bypass", "").lower() in ("1", "true", "yes")
+            or "no-cache" in request.headers.get("cache-control", "").lower())
 
 
-@app.post("/api/request", response_model=PredictionResponse)
-async def predict(body: PredictionRequest):
+ProgressCallback = Callable[[str, Any], Awaitable[None]]
+
+
+async def solve(body: PredictionRequest, plan: Optional[BatchPlan] = None,
+                progress: Optional[ProgressCallback] = None,
+                deadline: Optional[Deadline] = None) -> PredictionResponse:
+    resources: Resources = app.state.resources
+
+    # ретраи живут внутри стадий YaGPTResponse: повторяется только упавшая стадия
+    predictor = YaGPTResponse(query_id=body.id,
+                              question=body.query,
+                              resources=resources,
+                              prompts=resources.prompts,
+                              plan=plan,
+                              progress=progress,
+                              deadline=deadline, )
     try:
-        await logger.info(f"Processing prediction request with id: {body.id}")
+        answer = await predictor.answer()
+    finally:
+        await logger.info(f"Stage attempts for request {body.id} ({predictor.tier or 'unfinished'}): "
+                          f"{predictor.stage_attempts}")
+    await logger.info(f"Successfully processed request {body.id}")
+    return answer
+
+
+async def solve_and_cache(key: str, body: PredictionRequest, plan: Optional[BatchPlan] = None,
+                          progress: Optional[ProgressCallback] = None,
+                          deadline: Optional[Deadline] = None) -> dict:
+    """
+    Общее для всех одинаковых запросов вычисление: возвращает запись кэша,
+    из которой каждый запрос собирает ответ со своим id
+    """
+    answer = await solve(body, plan, progress, deadline)
+    entry = to_entry(body.query, answer)
+    # закрытый пакет отменил свои скачивания: ответ мог собраться без части страниц
+    if answer.answer != -1 and (plan is None or not plan.closed):
+        await answer_cache.set(key, entry)
+    return entry
+
+
+async def cached_answer(body: PredictionRequest, bypass: bool,
+                        plan: Optional[BatchPlan] = None,
+                        progress: Optional[ProgressCallback] = None,
+                        deadline: Optional[Deadline] = None) -> Tuple[PredictionResponse, str]:
+    """
+    Ответ из кэша или из общего вычисления, вместе со статусом кэша для X-Cache.
+    progress получает стадии, только если этот запрос сам запустил вычисление.
+    Вычисление с планом пакета склеивается только внутри этого пакета: план
+    отменяет свои задачи при отключении клиента пакета, и посторонние
+    запросы не должны от этого падать
+    """
+    key = question_key(body.query)
+    flight_key = key if plan is None else f"{key}:batch:{id(plan)}"
+    if bypass:
+        status = "BYPASS"
+    else:
+        entry = await answer_cache.get(key)
+        if entry is not None:
+            await logger.info(f"Answer cache hit for request {body.id}")
+            return from_entry(body.query, entry, body.id), "HIT"
+        status = "MISS"
+
+    entry = await in_flight.do(flight_key, lambda: solve_and_cache(key, body, plan, progress, deadline))
+    return from_entry(body.query, entry, body.id), status
 
-        sdk = YCloudML(
-            folder_id=catalogue_id,
-            auth=gpt_api_key,
-        )
 
-        for i in range(5):
+async def stream_answer(body: PredictionRequest, request: Request, bypass: bool):
+    """
+    SSE вариант /api/request: события query, sources и summary по мере
+    прохождения стадий, затем answer или error. Отключение клиента сразу
+    отменяет вычисление вместе со скачиванием страниц и вызовами llm
+    """
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def progress(stage: str, result: Any) -> None:
+        event = stage_event(stage, result)
+        if event is not None:
+            events.put_nowait(event)
+
+    task = asyncio.ensure_future(cached_answer(body, bypass, progress=progress))
+    task.add_done_callback(lambda _: events.put_nowait(None))
+    disconnect = asyncio.ensure_future(wait_disconnect(request.receive))
+    disconnect.add_done_callback(lambda _: task.cancel())
+    try:
+        while True:
             try:
-                predictor = YaGPTResponse(query_id=body.id,
-                                          question=body.query,
-                                          sdk=sdk,
-                                          temperature=0.3,
-                                          search_api_key=search_api_key, )
-                answer = await predictor.answer()
-                await logger.info(f"Successfully processed request {body.id}")
-                break
-            except LLMWorkflowError as e:
-                await logger.error(f"LLM workflow failed for request {body.id}: {e}, retrying {i + 1}")
+                event = await asyncio.wait_for(events.get(), SSE_PING_INTERVAL)
+            except asyncio.TimeoutError:
+                yield PING
                 continue
-            except ValueError as e:
-                await logger.error(
-                    f'LLM generated fake answer with invalid answer for request {body.id}: {e},  retrying {i + 1}')
+            if event is None:
+                break
+            yield format_event(*event)
+
+        if task.cancelled():
+            await logger.info(f"Client disconnected, request {body.id} cancelled")
+            return
+        try:
+            answer, cache_status = task.result()
+            yield format_event("answer", {**answer.model_dump(), "cache": cache_status})
+        except DeadlineExceeded as e:
+            await logger.error(f"Deadline exceeded for request {body.id}: {e}")
+            yield format_event("error", {"status": 504, "detail": str(e)})
+        except RateLimited as e:
+            await logger.warning(f"Throttled request {body.id}: {e}")
+            yield format_event("error", {"status": 503, "detail": str(e), "retry_after": e.retry_after})
+        except LLMWorkflowError as e:
+            await logger.error(f"LLM workflow failed for request {body.id}: {e}")
+            yield format_event("error", {"status": 500, "detail": str(e)})
+        except Exception as e:
+            await logger.error(f"Internal error processing request {body.id}: {str(e)}")
+            yield format_event("error", {"status": 500, "detail": "Internal server error"})
+    finally:
+        disconnect.cancel()
+        task.cancel()
+
+
+@app.post("/api/request", response_model=PredictionResponse)
+async def predict(body: PredictionRequest, request: Request, response: Response):
+    """С заголовком Accept: text/event-stream ответ приходит потоком SSE событий"""
+    if wants_stream(request.headers.get("accept", "")):
+        await logger.info(f"Streaming prediction request with id: {body.id}")
+        return StreamingResponse(stream_answer(body, request, cache_bypassed(request)),
+                                 media_type=SSE_MEDIA_TYPE, headers=SSE_HEADERS)
+    try:
+        await logger.info(f"Processing prediction request with id: {body.id}")
+        answer, cache_status = await cached_answer(body, cache_bypassed(request))
+        response.headers["X-Cache"] = cache_status
         return answer
+    except DeadlineExceeded as e:
+        await logger.error(f"Deadline exceeded for request {body.id}: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
+    except RateLimited as e:
+        await logger.warning(f"Throttled request {body.id}: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except LLMWorkflowError as e:
         await logger.error(f"LLM workflow failed for request {body.id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         await logger.error(f"Internal error processing request {body.id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
+
+
+@app.post("/api/requests")
+async def predict_batch(bodies: List[PredictionRequest], request: Request):
+    """
+    Пакет вопросов: поиск и скачивание страниц общие для всего пакета,
+    ответы отдаются ndjson строками по мере готовности. Ошибка одного
+    вопроса приходит строкой {"id": ..., "detail": ...} и не ломает остальные
+    """
+    if len(bodies) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch is limited to {BATCH_MAX_SIZE} questions")
+
+    bypass = cache_bypassed(request)
+    plan = BatchPlan()
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    await logger.info(f"Processing batch of {len(bodies)} requests")
+
+    async def run_item(body: PredictionRequest) -> str:
+        async with semaphore:
+            try:
+                answer, _ = await cached_answer(body, bypass, plan)
+                return answer.model_dump_json()
+            except RateLimited as e:
+                await logger.warning(f"Throttled request {body.id}: {e}")
+                return json.dumps({"id": body.id, "detail": str(e), "retry_after": e.retry_after},
+                                  ensure_ascii=False)
+            except LLMWorkflowError as e:
+                await logger.error(f"LLM workflow failed for request {body.id}: {e}")
+                return json.dumps({"id": body.id, "detail": str(e)}, ensure_ascii=False)
+            except Exception as e:
+                await logger.error(f"Internal error processing request {body.id}: {str(e)}")
+                return json.dumps({"id": body.id, "detail": "Internal server error"})
+
+    async def results():
+        tasks = [asyncio.ensure_future(run_item(body)) for body in bodies]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished + "\n"
+        finally:
+            # клиент мог отключиться посреди пакета
+            for task in tasks:
+                task.cancel()
+            plan.close()
+            await logger.info(f"Batch of {len(bodies)} requests finished: {plan.stats()}")
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+async def run_job(job: Job, progress: Callable[[str], Awaitable[None]]) -> dict:
+    """Решает вопрос задачи тем же путем, что и /api/request, но с бюджетом JOBS_DEADLINE"""
+    body = PredictionRequest(id=job.query_id, query=job.query)
+
+    async def report(stage: str, result: Any) -> None:
+        # в задаче хранятся только пройденные стадии, выжимки источников отдает SSE
+        if stage != "summary":
+            await progress(stage)
+
+    await logger.info(f"Processing job {job.id} for request {body.id}")
+    answer, _ = await cached_answer(body, False, progress=report, deadline=Deadline(JOBS_DEADLINE))
+    return answer.model_dump()
+
+
+job_queue = JobQueue(job_store, run_job)
+
+
+def job_response(job: Job) -> JobResponse:
+    return JobResponse(id=job.id, status=job.status, stages=job.stages, result=job.result, error=job.error)
+
+
+@app.post("/api/jobs", response_model=JobResponse, status_code=202)
+async def submit_job(body: JobRequest, response: Response):
+    """
+    Ставит вопрос в очередь воркера и сразу возвращает id задачи.
+    Если очередь заполнена, отвечает 503 с Retry-After
+    """
+    try:
+        job = await job_queue.submit(body.id, body.query, body.priority)
+    except JobQueueFull as e:
+        await logger.warning(f"Job for request {body.id} rejected: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(JOBS_RETRY_AFTER)})
+    response.headers["Location"] = f"/api/jobs/{job.id}"
+    return job_response(job)
+
+
+@app.get("/api/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str, wait: float = 0):
+    """
+    Состояние задачи. С wait > 0 это long-poll: ответ приходит, когда
+    задача продвинулась на следующую стадию или завершилась (не дольше JOBS_MAX_WAIT)
+    """
+    job = await job_store.wait(job_id, min(wait, JOBS_MAX_WAIT))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
+
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return {
+        "answers": answer_cache.stats(),
+        "summaries": summary_cache.stats(),
+        "in_flight": in_flight.stats(),
+        "rate_limits": limiter_stats(),
+        "jobs": job_queue.stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -1,6 +1,6 @@
-from typing import List
+from typing import List, Optional
 
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl
 
 
 class PredictionRequest(BaseModel):
@@ -13,3 +13,16 @@ class PredictionResponse(BaseModel):
     answer: int
     reasoning: str
     sources: List[str]
+
+
+class JobRequest(PredictionRequest):
+    # меньше - раньше, как приоритеты планировщика llm
+    priority: int = Field(default=1, ge=0, le=9)
+
+
+class JobResponse(BaseModel):
+    id: str
+    status: str
+    stages: List[str]
+    result: Optional[PredictionResponse] = None
+    error: Optional[str] = None
@@ -0,0 +1,221 @@
+"""
+Заглушки внешних сервисов для офлайн бенчмарка: YandexGPT completions,
+xml api Яндекс поиска и веб-сервер с сохраненными страницами ИТМО.
+Задержки, ошибки и ограничение частоты настраиваются, поэтому можно
+воспроизвести и спокойный режим, и троттлинг под нагрузкой
+"""
+import asyncio
+import json
+import pathlib
+import random
+import re
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import grpc
+from aiohttp import web
+from grpc.aio import AioRpcError, Metadata
+from yandex_cloud_ml_sdk import AsyncYCloudML
+
+from utils.questions import normalize_text, split_options
+
+PAGES_DIR = pathlib.Path(__file__).resolve().parent.parent / 'fixtures' / 'pages'
+URL_PATTERN = re.compile(r'https?://[^\s\'",}\]]+')
+WORD_PATTERN = re.compile(r'\w{4,}')
+
+
+class FakeCompletion:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeLLM:
+    """
+    Общее состояние фейкового YandexGPT: лимит частоты и счетчики
+    вызовов всех моделей, созданных через sdk()
+    """
+
+    def __init__(self,
+                 latency: float = 0.3,
+                 jitter: float = 0.1,
+                 error_rate: float = 0.0,
+                 garbage_rate: float = 0.0,
+                 sloppy_rate: float = 0.0,
+                 direct_rate: float = 0.0,
+                 max_rps: float = 0.0,
+                 seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.garbage_rate = garbage_rate
+        self.sloppy_rate = sloppy_rate
+        self.direct_rate = direct_rate
+        self.max_rps = max_rps
+        self.calls: Counter = Counter()
+        self._random = random.Random(seed)
+        self._recent: Deque[float] = deque()
+
+    def sdk(self, folder_id: str = 'offline', auth: Optional[str] = None) -> 'FakeSDK':
+        """Подменяет конструктор AsyncYCloudML"""
+        return FakeSDK(self, folder_id)
+
+    def _admit(self) -> None:
+        """Скользящее окно в одну секунду: сверх max_rps отвечаем RESOURCE_EXHAUSTED, как настоящий api"""
+        if not self.max_rps:
+            return
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > 1:
+            self._recent.popleft()
+        if len(self._recent) >= self.max_rps:
+            self.calls['throttled'] += 1
+            raise AioRpcError(grpc.StatusCode.RESOURCE_EXHAUSTED, Metadata(), Metadata(), details='quota exceeded')
+        self._recent.append(now)
+
+    async def complete(self, messages: List[Dict[str, str]]) -> str:
+        self._admit()
+        await asyncio.sleep(max(0.0, self._random.gauss(self.latency, self.jitter)))
+        if self._random.random() < self.error_rate:
+            self.calls['error'] += 1
+            raise AioRpcError(grpc.StatusCode.UNAVAILABLE, Metadata(), Metadata(), details='fake outage')
+
+        kind, text = self.respond(messages)
+        self.calls[kind] += 1
+        if kind in ('query', 'final', 'direct') and self._random.random() < self.garbage_rate:
+            # ответ без разделителя и json заставляет пайплайн звать cleanup модель
+            self.calls['garbage'] += 1
+            return 'Не удалось сформулировать ответ в нужном формате'
+        if kind in ('query', 'final', 'direct') and self._random.random() < self.sloppy_rate:
+            # json в блоке кода, с одинарными кавычками и висящей запятой, как часто пишет llm
+            self.calls['sloppy'] += 1
+            reasoning, _, payload = text.partition('---')
+            payload = payload.strip().replace('"', "'").replace('}', ',}')
+            return f'{reasoning}```json\n{payload}\n```'
+        return text
+
+    def respond(self, messages: List[Dict[str, str]]) -> Tuple[str, str]:
+        """Правдоподобный ответ по виду промпта"""
+        system, user = messages[0]['text'], messages[-1]['text']
+        if 'valid json' in system:
+            if '"query"' in system:
+                return 'cleanup', json.dumps({'query': 'университет итмо'}, ensure_ascii=False)
+            match = re.search(r'\{.*\}', user, re.S)
+            return 'cleanup', match.group(0) if match else '{"answer": -1, "reasoning": "", "sources": []}'
+        if '"confidence"' in system:
+            # уверенно отвечает на долю direct_rate вопросов, остальные уходят в поиск
+            confident = self._random.random() < self.direct_rate
+            payload = {'answer': 1, 'confidence': 0.95 if confident else 0.3,
+                       'reasoning': 'Общеизвестный факт.', 'sources': []}
+            return 'direct', f'Отвечаю по своим знаниям.\n---\n{json.dumps(payload, ensure_ascii=False)}'
+        if system.startswith('Сократи'):
+            return 'summary', user[:600]
+        if user.startswith('# Факты'):
+            return 'final', FakeLLM.final_answer(user)
+        stem, _ = split_options(user)
+        return 'query', f'Нужны официальные источники ИТМО.\n---\n{json.dumps({"query": stem}, ensure_ascii=False)}'
+
+    @staticmethod
+    def final_answer(user: str) -> str:
+        facts, _, question = user.partition('Ответь на мой вопрос: ')
+        facts = normalize_text(facts)
+        _, options = split_options(question)
+        scores = {number: facts.count(text) for number, text in options if text}
+        answer = max(scores, key=scores.get) if scores and max(scores.values()) else -1
+        sources = list(dict.fromkeys(URL_PATTERN.findall(facts)))
+        payload = {'answer': answer, 'reasoning': 'Ответ найден в источниках.', 'sources': sources}
+        return f'Сверяю варианты с фактами.\n---\n{json.dumps(payload, ensure_ascii=False)}'
+
+
+class FakeModel:
+    def __init__(self, llm: FakeLLM, folder_id: str, name: str):
+        self._llm = llm
+        self.uri = f'gpt://{folder_id}/{name}/latest'
+
+    def configure(self, **kwargs) -> 'FakeModel':
+        return self
+
+    async def run(self, messages: List[Dict[str, str]]) -> List[FakeCompletion]:
+        return [FakeCompletion(await self._llm.complete(messages))]
+
+
+class FakeModels:
+    def __init__(self, llm: FakeLLM, folder_id: str):
+        self._llm = llm
+        self._folder_id = folder_id
+
+    def completions(self, name: str) -> FakeModel:
+        return FakeModel(self._llm, self._folder_id, name)
+
+
+class FakeSDK(AsyncYCloudML):
+    """Наследник AsyncYCloudML, чтобы его принимали там же, где настоящий sdk"""
+
+    def __init__(self, llm: FakeLLM, folder_id: str):
+        self._folder_id = folder_id
+        self.models = FakeModels(llm, folder_id)
+
+
+def page_words(path: pathlib.Path) -> set:
+    return set(WORD_PATTERN.findall(path.read_text(encoding='utf-8').lower()))
+
+
+def search_app(pages_url: str, pages_dir: pathlib.Path = PAGES_DIR, latency: float = 0.0,
+               mirrors: int = 1) -> web.Application:
+    """
+    Фейковый xml api Яндекс поиска: выдает страницы из pages_dir,
+    отсортированные по пересечению слов с запросом. mirrors > 1 выдает
+    каждую страницу еще и по зеркальным путям, чтобы кандидатов было больше
+    """
+    index = {path.name: page_words(path) for path in sorted(pages_dir.glob('*.html'))}
+
+    async def handle(request: web.Request) -> web.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        terms = set(WORD_PATTERN.findall(request.query.get('query', '').lower()))
+        ranked = sorted(index, key=lambda name: len(terms & index[name]), reverse=True)
+        urls = [f'{pages_url}/{name}' for name in ranked]
+        urls += [f'{pages_url}/mirror{mirror}/{name}' for mirror in range(1, mirrors) for name in ranked]
+        groups = ''.join(f'<group><doc><url>{escape(url)}</url><mime-type>text/html</mime-type></doc></group>'
+                         for url in urls)
+        body = (f'<?xml version="1.0" encoding="utf-8"?><yandexsearch version="1.0"><response><results>'
+                f'<grouping>{groups}</grouping></results></response></yandexsearch>')
+        return web.Response(text=body, content_type='text/xml')
+
+    app = web.Application()
+    app.router.add_get('/search/xml', handle)
+    return app
+
+
+def pages_app(pages_dir: pathlib.Path = PAGES_DIR, latency: float = 0.0,
+              slow_rate: float = 0.0, slow_latency: float = 0.0, seed: Optional[int] = None) -> web.Application:
+    """
+    Отдает сохраненные страницы, FileResponse сам отвечает 304 на условные
+    запросы. Доля slow_rate ответов задерживается на slow_latency - так
+    выглядит медленный хост в выдаче
+    """
+    rng = random.Random(seed)
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        delay = slow_latency if rng.random() < slow_rate else latency
+        if delay:
+            await asyncio.sleep(delay)
+        path = pages_dir / request.match_info['name']
+        if not path.is_file():
+            raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={'Content-Type': 'text/html; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/{name}', handle)
+    app.router.add_get('/{mirror}/{name}', handle)
+    return app
+
+
+async def serve(app: web.Application, host: str = '127.0.0.1') -> Tuple[web.AppRunner, str]:
+    """Запускает приложение на свободном порту, возвращает runner и базовый url"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://{host}:{port}'
@@ -0,0 +1,207 @@
+"""
+Генератор нагрузки на /api/request.
+
+    python -m tests.bench.loadgen --url http://localhost:8080/api/request --concurrency 8 --requests 100
+    python -m tests.bench.loadgen --rate 4 --duration 60 --out report.json --compare baseline.json
+
+Два режима: фиксированное число одновременных клиентов (закрытая модель)
+или пуассоновский поток с заданной частотой (открытая модель, запросы
+не ждут друг друга). Отчет - json с пропускной способностью, долей
+ошибок и p50/p95/p99 всего запроса и каждой стадии из Server-Timing
+(у сервиса должен быть включен SERVER_TIMING_HEADER=1)
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from tests.test_cases import LOCAL_API_URL, test_cases
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    """`search;dur=12.5, final_answer;dur=300` -> {'search': 12.5, 'final_answer': 300.0}"""
+    timings = {}
+    for metric in filter(None, (part.strip() for part in header.split(','))):
+        name, *params = metric.split(';')
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                timings[name.strip()] = float(value)
+    return timings
+
+
+async def send(client: httpx.AsyncClient, url: str, request_id: int, case: dict,
+               headers: Dict[str, str], results: List[dict]) -> None:
+    started = time.perf_counter()
+    record = {'id': request_id, 'status': 0, 'stages': {}}
+    try:
+        response = await client.post(url, json={'id': request_id, 'query': case['question']}, headers=headers)
+        record['status'] = response.status_code
+        record['stages'] = parse_server_timing(response.headers.get('server-timing', ''))
+        if response.status_code == 200:
+            record['correct'] = response.json().get('answer') == case.get('answer')
+    except httpx.HTTPError as e:
+        record['error'] = type(e).__name__
+    record['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    results.append(record)
+
+
+async def run_load(url: str,
+                   cases: List[dict],
+                   requests: int,
+                   concurrency: int = 4,
+                   rate: float = 0.0,
+                   duration: float = 0.0,
+                   timeout: float = 420,
+                   headers: Optional[Dict[str, str]] = None,
+                   seed: int = 0) -> dict:
+    """
+    При rate > 0 запросы приходят пуассоновским потоком до requests штук
+    или duration секунд, иначе concurrency клиентов шлют запросы подряд
+    """
+    headers = headers or {}
+    results: List[dict] = []
+    rng = random.Random(seed)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=concurrency)
+    started = time.perf_counter()
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        if rate > 0:
+            tasks = []
+            request_id = 0
+            while request_id < requests and (not duration or time.perf_counter() - started < duration):
+                case = cases[request_id % len(cases)]
+                tasks.append(asyncio.create_task(send(client, url, request_id, case, headers, results)))
+                request_id += 1
+                await asyncio.sleep(rng.expovariate(rate))
+            await asyncio.gather(*tasks)
+        else:
+            counter = iter(range(requests))
+
+            async def worker():
+                for request_id in counter:
+                    if duration and time.perf_counter() - started >= duration:
+                        return
+                    await send(client, url, request_id, cases[request_id % len(cases)], headers, results)
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    wall = time.perf_counter() - started
+    mode = {'rate': rate} if rate > 0 else {'concurrency': concurrency}
+    return summarize(results, wall, mode)
+
+
+def distribution(values: List[float]) -> Dict[str, float]:
+    return {f'p{q}': percentile(values, q) for q in PERCENTILES}
+
+
+def summarize(results: List[dict], wall: float, mode: dict) -> dict:
+    ok = [result for result in results if result['status'] == 200]
+    statuses: Dict[str, int] = {}
+    for result in results:
+        key = str(result['status'] or result.get('error', 'error'))
+        statuses[key] = statuses.get(key, 0) + 1
+
+    stages: Dict[str, List[float]] = {}
+    for result in ok:
+        for stage, duration in result['stages'].items():
+            stages.setdefault(stage, []).append(duration)
+
+    return {
+        'mode': mode,
+        'requests': len(results),
+        'wall_s': round(wall, 2),
+        'throughput_rps': round(len(ok) / wall, 3) if wall else 0.0,
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else 0.0,
+        'accuracy': round(sum(bool(result.get('correct')) for result in ok) / len(ok), 4) if ok else 0.0,
+        'statuses': statuses,
+        'latency_ms': distribution([result['latency_ms'] for result in ok]),
+        'stages_ms': {stage: distribution(values) for stage, values in sorted(stages.items())},
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.2) -> List[str]:
+    """
+    Регрессии относительно baseline: рост p50/p95 больше чем на tolerance,
+    падение пропускной способности и рост доли ошибок
+    """
+    regressions = []
+    pairs = [('latency', report['latency_ms'], baseline.get('latency_ms', {}))]
+    pairs += [(stage, values, baseline.get('stages_ms', {}).get(stage, {}))
+              for stage, values in report['stages_ms'].items()]
+    for name, current, previous in pairs:
+        for key in ('p50', 'p95'):
+            if previous.get(key) and current[key] > previous[key] * (1 + tolerance):
+                regressions.append(f'{name} {key}: {previous[key]} -> {current[key]} ms')
+    if baseline.get('throughput_rps') and report['throughput_rps'] < baseline['throughput_rps'] * (1 - tolerance):
+        regressions.append(f"throughput: {baseline['throughput_rps']} -> {report['throughput_rps']} rps")
+    if report['error_rate'] > baseline.get('error_rate', 0) + 0.01:
+        regressions.append(f"error rate: {baseline.get('error_rate', 0)} -> {report['error_rate']}")
+    return regressions
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['requests']} requests in {report['wall_s']} s, {report['throughput_rps']} rps, "
+          f"errors {report['error_rate']:.1%}, accuracy {report['accuracy']:.1%}, statuses {report['statuses']}")
+    print(f"{'stage':<16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, values in [('total', report['latency_ms'])] + list(report['stages_ms'].items()):
+        print(f"{name:<16} {values['p50']:>9} {values['p95']:>9} {values['p99']:>9}")
+
+
+def add_load_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0.0, help='запросов в секунду, открытая модель')
+    parser.add_argument('--duration', type=float, default=0.0, help='ограничение по времени, секунды')
+    parser.add_argument('--use-cache', action='store_true', help='не слать X-Cache-Bypass')
+    parser.add_argument('--out', help='куда сохранить отчет json')
+    parser.add_argument('--compare', help='baseline json для поиска регрессий')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+
+
+def finish(report: dict, args: argparse.Namespace) -> int:
+    """Печатает и сохраняет отчет, при регрессиях возвращает ненулевой код"""
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as out:
+            json.dump(report, out, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=LOCAL_API_URL)
+    add_load_arguments(parser)
+    args = parser.parse_args()
+
+    headers = {} if args.use_cache else {'X-Cache-Bypass': '1'}
+    report = asyncio.run(run_load(args.url, test_cases, args.requests, args.concurrency, args.rate,
+                                  args.duration, headers=headers))
+    sys.exit(finish(report, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Офлайн бенчмарк сервиса целиком, без платных api и интернета.
+
+    python -m tests.bench.run_offline --concurrency 8 --requests 100 --out baseline.json
+    python -m tests.bench.run_offline --rate 5 --llm-max-rps 8 --compare baseline.json
+
+Поднимает на свободных портах фейковый xml api поиска и сервер со
+страницами из tests/fixtures/pages, кладет в app.state ресурсы с FakeLLM
+и запускает приложение в uvicorn внутри этого же процесса. Затем
+tests.bench.loadgen гоняет нагрузку по /api/request и печатает отчет.
+По умолчанию кэши ответов, выжимок и страниц выключены, чтобы мерить
+холодный путь целиком
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+
+import uvicorn
+
+from tests.bench.fakes import FakeLLM, PAGES_DIR, pages_app, search_app, serve
+from tests.bench.loadgen import add_load_arguments, finish, run_load
+from tests.test_cases import test_cases
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def configure_env(search_url: str, workdir: str, use_cache: bool, index: str = '') -> None:
+    """Настройки читаются модулями при импорте, поэтому env выставляется до импорта main"""
+    os.environ.update({
+        'YA_CATALOG_ID': 'offline',
+        'YA_GPT_KEY': 'offline',
+        'YA_SEARCH_KEY': 'offline',
+        'YA_SEARCH_URL': f'{search_url}/search/xml',
+        'SERVER_TIMING_HEADER': '1',
+        'RATE_LIMIT_DIR': os.path.join(workdir, 'rate_limits'),
+        'ACCESS_LOG_PATH': os.path.join(workdir, 'access.jsonl'),
+        'JOBS_PATH': os.path.join(workdir, 'jobs.sqlite'),
+        # без --index локальный индекс не используется, чтобы мерить путь через поиск
+        'INDEX_PATH': index,
+    })
+    if use_cache:
+        os.environ.update({
+            'ANSWER_CACHE_PATH': os.path.join(workdir, 'answers.sqlite'),
+            'SUMMARY_CACHE_PATH': os.path.join(workdir, 'summaries.sqlite'),
+            'PAGE_CACHE_PATH': os.path.join(workdir, 'pages.sqlite'),
+        })
+    else:
+        os.environ.update({
+            'ANSWER_CACHE_SIZE': '0', 'ANSWER_CACHE_PATH': '',
+            'SUMMARY_CACHE_SIZE': '0', 'SUMMARY_CACHE_PATH': '',
+            'PAGE_CACHE_PATH': '',
+        })
+
+
+async def run(args: argparse.Namespace) -> dict:
+    llm = FakeLLM(latency=args.llm_latency, jitter=args.llm_jitter, error_rate=args.llm_error_rate,
+                  garbage_rate=args.llm_garbage_rate, sloppy_rate=args.llm_sloppy_rate, direct_rate=args.llm_direct_rate,
+                  max_rps=args.llm_max_rps, seed=args.seed)
+    pages_runner, pages_url = await serve(pages_app(PAGES_DIR, args.page_latency, args.slow_page_rate,
+                                                    args.slow_page_latency, args.seed))
+    search_runner, search_url = await serve(search_app(pages_url, PAGES_DIR, args.search_latency, args.mirrors))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_env(search_url, workdir, args.use_cache, args.index)
+        import main
+        from utils.resources import Resources
+        main.app.state.resources = Resources(llm.sdk(), 'offline', prompts=main.prompts)
+
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            if server_task.done():
+                raise RuntimeError('uvicorn failed to start')
+            await asyncio.sleep(0.05)
+
+        try:
+            headers = {} if args.use_cache else {'X-Cache-Bypass': '1'}
+            report = await run_load(f'http://127.0.0.1:{port}/api/request', test_cases, args.requests,
+                                    args.concurrency, args.rate, args.duration, headers=headers, seed=args.seed)
+        finally:
+            server.should_exit = True
+            await server_task
+            await search_runner.cleanup()
+            await pages_runner.cleanup()
+
+    report['fake_llm'] = {'latency': args.llm_latency, 'jitter': args.llm_jitter,
+                          'error_rate': args.llm_error_rate, 'garbage_rate': args.llm_garbage_rate,
+                          'sloppy_rate': args.llm_sloppy_rate, 'direct_rate': args.llm_direct_rate,
+                          'max_rps': args.llm_max_rps, 'calls': dict(llm.calls)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_load_arguments(parser)
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='средняя задержка completions, секунды')
+    parser.add_argument('--llm-jitter', type=float, default=0.1)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='доля ответов UNAVAILABLE')
+    parser.add_argument('--llm-garbage-rate', type=float, default=0.0, help='доля ответов без json')
+    parser.add_argument('--llm-sloppy-rate', type=float, default=0.0,
+                        help='доля ответов с json в блоке кода, одинарными кавычками и висящей запятой')
+    parser.add_argument('--llm-direct-rate', type=float, default=0.0,
+                        help='доля вопросов, на которые llm уверенно отвечает без поиска')
+    parser.add_argument('--llm-max-rps', type=float, default=0.0, help='выше - RESOURCE_EXHAUSTED, 0 без лимита')
+    parser.add_argument('--search-latency', type=float, default=0.05)
+    parser.add_argument('--page-latency', type=float, default=0.05)
+    parser.add_argument('--slow-page-rate', type=float, default=0.0, help='доля страниц с задержкой --slow-page-latency')
+    parser.add_argument('--slow-page-latency', type=float, default=10.0)
+    parser.add_argument('--mirrors', type=int, default=1, help='сколько раз каждая страница встречается в выдаче')
+    parser.add_argument('--index', default='', help='собранный utils.retrieval_index, по умолчанию выключен')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(f"fake llm calls: {report['fake_llm']['calls']}")
+    sys.exit(finish(report, args))
+
+
+if __name__ == '__main__':
+    main()
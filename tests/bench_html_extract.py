@@ -0,0 +1,70 @@
+"""
+Микро-бенчмарк движков извлечения текста из html.
+
+    python -m tests.bench_html_extract [--pages tests/fixtures/pages] [--inflate 50] [--repeat 20]
+
+Для каждого бэкенда из utils.html_extract меряет пропускную способность на
+страницах из --pages (по умолчанию синтетические заглушки, размноженные --inflate) и сравнивает окна вокруг ключевых слов с эталонным bs4:
+количество окон и долю общих слов (jaccard)
+"""
+import argparse
+import pathlib
+import re
+import time
+
+from utils.html_extract import BACKENDS, extract
+from utils.keyword_windows import extract_windows
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def inflate(html: str, times: int) -> str:
+    """Размножает содержимое body, чтобы получить страницу реального размера"""
+    start, end = html.find('<body'), html.rfind('</body>')
+    if times <= 1 or start == -1 or end == -1:
+        return html
+    start = html.find('>', start) + 1
+    return html[:start] + html[start:end] * times + html[end:]
+
+
+def keyword_windows(text: str) -> str:
+    # bs4 не схлопывает переводы строк внутри узлов, приводим все бэкенды к одному виду
+    return extract_windows(' '.join(text.split()))
+
+
+def jaccard(first: str, second: str) -> float:
+    a, b = set(WORD_PATTERN.findall(first)), set(WORD_PATTERN.findall(second))
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', default='tests/fixtures/pages')
+    parser.add_argument('--inflate', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    pages = {path.name: inflate(path.read_text(encoding='utf-8'), args.inflate)
+             for path in sorted(pathlib.Path(args.pages).glob('*.html'))}
+    total_mb = sum(len(html.encode('utf-8')) for html in pages.values()) / 2 ** 20
+    print(f'{len(pages)} pages, {total_mb:.2f} MB per pass, {args.repeat} passes')
+
+    baseline = {name: keyword_windows(extract(html, 'bs4')) for name, html in pages.items()}
+
+    print(f"{'backend':<8} {'MB/s':>8} {'speedup':>8} {'windows':>8} {'jaccard':>8}")
+    bs4_speed = None
+    for backend in BACKENDS:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            texts = {name: extract(html, backend) for name, html in pages.items()}
+        speed = total_mb * args.repeat / (time.perf_counter() - start)
+        bs4_speed = bs4_speed or speed
+
+        windows = {name: keyword_windows(text) for name, text in texts.items()}
+        window_count = sum(len(w.splitlines()) for w in windows.values())
+        similarity = min(jaccard(windows[name], baseline[name]) for name in pages)
+        print(f'{backend:<8} {speed:>8.2f} {speed / bs4_speed:>7.1f}x {window_count:>8} {similarity:>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
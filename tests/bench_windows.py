@@ -0,0 +1,93 @@
+"""
+Бенчмарк извлечения окон вокруг ключевых слов.
+
+    python -m tests.bench_windows [--sizes 100000,1000000,4000000] [--densities 0.05,0.3]
+
+Сравнивает прежний подход (два прохода str.find, слияние списков и
+indexes.pop(0), квадратичное на плотных страницах) с однопроходным
+utils.keyword_windows на синтетических страницах разного размера
+"""
+import argparse
+import random
+import time
+from typing import List
+
+from utils.keyword_windows import extract_windows, find_windows
+
+FILLER = 'студенты лаборатории исследования кампус программы олимпиады наука'.split()
+
+
+def legacy_windows(source: str, bound: int = 100) -> str:
+    """Прежняя реализация bounds_based_parse для сравнения"""
+
+    def find_all(a_str, sub):
+        start = 0
+        while True:
+            start = a_str.find(sub, start)
+            if start == -1:
+                return
+            yield start
+            start += len(sub)
+
+    def merge_sorted_indexes(list1, list2):
+        merged = []
+        i, j = 0, 0
+        while i < len(list1) and j < len(list2):
+            if list1[i] < list2[j]:
+                merged.append(list1[i])
+                i += 1
+            else:
+                merged.append(list2[j])
+                j += 1
+        merged.extend(list1[i:])
+        merged.extend(list2[j:])
+        return merged
+
+    indexes: List[int] = merge_sorted_indexes(list(find_all(source, 'итмо')), list(find_all(source, 'itmo')))
+    result = []
+    while indexes:
+        center = indexes.pop(0)
+        start, end = max(0, center - bound), min(len(source), center + bound)
+        while indexes and indexes[0] - (2 * bound) < end:
+            center = indexes.pop(0)
+            end = min(len(source), center + bound)
+        result.append(source[start:end])
+    return '\n'.join(result)
+
+
+def make_page(size: int, density: float, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words, length = [], 0
+    while length < size:
+        word = rng.choice(('итмо', 'itmo')) if rng.random() < density else rng.choice(FILLER)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='100000,500000,1000000,4000000')
+    parser.add_argument('--densities', default='0.05,0.3', help='доли слов-ключей на странице')
+    args = parser.parse_args()
+
+    print(f"{'density':>8} {'chars':>10} {'keywords':>9} {'legacy s':>9} {'single s':>9} {'speedup':>8} {'windows':>8}")
+    for density in map(float, args.densities.split(',')):
+        for size in map(int, args.sizes.split(',')):
+            page = make_page(size, density)
+            keywords = page.count('итмо') + page.count('itmo')
+            legacy = timed(legacy_windows, page)
+            single = timed(extract_windows, page)
+            windows = len(find_windows(page))
+            print(f'{density:>8} {size:>10} {keywords:>9} {legacy:>9.3f} {single:>9.3f} '
+                  f'{legacy / single:>7.1f}x {windows:>8}')
+
+
+if __name__ == '__main__':
+    main()
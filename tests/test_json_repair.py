@@ -0,0 +1,77 @@
+import pytest
+
+from utils.json_repair import DIRECT_SCHEMA, FINAL_SCHEMA, QUERY_SCHEMA, extract_json, loads
+
+
+def test_strict_json_is_not_repaired():
+    value, path = extract_json('{"query": "приемная комиссия итмо"}', QUERY_SCHEMA)
+    assert value == {'query': 'приемная комиссия итмо'}
+    assert path == 'strict'
+
+
+def test_single_quotes_are_swapped():
+    value, repaired = loads("{'answer': 2, 'reasoning': 'it's fine', 'sources': ['https://itmo.ru']}")
+    assert repaired
+    assert value == {'answer': 2, 'reasoning': "it's fine", 'sources': ['https://itmo.ru']}
+
+
+def test_inner_quotes_and_newlines_are_escaped():
+    value, _ = loads('{"reasoning": "университет "ИТМО"\nоснован в 1900", "answer": 1}')
+    assert value == {'reasoning': 'университет "ИТМО"\nоснован в 1900', 'answer': 1}
+
+
+def test_python_literals_and_trailing_commas():
+    value, _ = loads("{'ok': True, 'missing': None, 'list': [1, 2,],}")
+    assert value == {'ok': True, 'missing': None, 'list': [1, 2]}
+
+
+def test_truncated_output_is_closed():
+    value, repaired = loads('{"answer": 3, "reasoning": "обрезано на полусл')
+    assert repaired
+    assert value == {'answer': 3, 'reasoning': 'обрезано на полусл'}
+
+
+def test_truncated_output_drops_unfinished_pair():
+    value, _ = loads('{"answer": 3, "sources": ["https://itmo.ru", "https://news.itmo.ru"], "reasoning":')
+    assert value['answer'] == 3
+    assert value['sources'] == ['https://itmo.ru', 'https://news.itmo.ru']
+
+
+def test_unrecoverable_text_raises():
+    with pytest.raises(ValueError):
+        loads('{"answer": }}}')
+
+
+def test_last_object_is_selected():
+    text = ('Пример формата: {"answer": 0, "reasoning": "пример", "sources": []}\n'
+            'Итог: {"answer": 4, "reasoning": "ответ", "sources": []}')
+    value, _ = extract_json(text, FINAL_SCHEMA)
+    assert value['answer'] == 4
+
+
+def test_part_after_separator_wins_over_reasoning():
+    text = 'Рассуждаю про {"answer": 1}...\n---\n{"answer": 2, "reasoning": "итог", "sources": []}'
+    value, _ = extract_json(text, FINAL_SCHEMA)
+    assert value['answer'] == 2
+
+
+def test_fenced_block_is_preferred():
+    text = '```json\n{"query": "из блока"}\n```\nи еще {"query": "из текста"}'
+    value, _ = extract_json(text, QUERY_SCHEMA)
+    assert value == {'query': 'из блока'}
+
+
+def test_object_without_required_field_is_skipped():
+    text = '{"answer": 5, "reasoning": "итог", "sources": []} {"note": "постскриптум"}'
+    value, _ = extract_json(text, FINAL_SCHEMA)
+    assert value['answer'] == 5
+
+
+def test_values_conform_to_schema():
+    value, _ = extract_json('{"answer": "3. Москва", "confidence": "0,9", "reasoning": null, '
+                            '"sources": "https://itmo.ru"}', DIRECT_SCHEMA)
+    assert value == {'answer': 3, 'confidence': 0.9, 'reasoning': '', 'sources': ['https://itmo.ru']}
+
+
+def test_no_json_fails():
+    assert extract_json('ответ без json', FINAL_SCHEMA) == (None, 'failed')
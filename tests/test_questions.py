@@ -0,0 +1,38 @@
+from schemas.request import PredictionResponse
+from utils.questions import from_entry, question_key, split_options, to_entry
+
+QUESTION = 'В каком городе находится ИТМО?\n1. Москва\n2. Санкт-Петербург\n3. Казань'
+SHUFFLED = '  в каком городе   находится итмо?\n1) Казань\n2) Москва\n3) Санкт-Петербург'
+
+
+def test_split_options():
+    stem, options = split_options(QUESTION)
+    assert stem == 'в каком городе находится итмо?'
+    assert options == [(1, 'москва'), (2, 'санкт-петербург'), (3, 'казань')]
+
+
+def test_key_ignores_case_spaces_and_option_order():
+    assert question_key(QUESTION) == question_key(SHUFFLED)
+
+
+def test_key_depends_on_options():
+    assert question_key(QUESTION) != question_key(QUESTION.replace('Казань', 'Пермь'))
+
+
+def test_answer_is_remapped_to_new_option_order():
+    response = PredictionResponse(id=1, answer=2, reasoning='Университет в Петербурге', sources=['https://itmo.ru'])
+    entry = to_entry(QUESTION, response)
+    assert entry['answer_text'] == 'санкт-петербург'
+
+    restored = from_entry(SHUFFLED, entry, query_id=7)
+    assert restored.id == 7
+    assert restored.answer == 3
+    assert restored.reasoning == response.reasoning
+    assert restored.sources == response.sources
+
+
+def test_answer_without_options_is_kept():
+    response = PredictionResponse(id=1, answer=-1, reasoning='Открытый вопрос', sources=[])
+    entry = to_entry('Когда основан ИТМО?', response)
+    assert entry['answer_text'] is None
+    assert from_entry('когда основан итмо?', entry, query_id=2).answer == -1
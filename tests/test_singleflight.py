@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from utils.singleflight import SingleFlight
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_identical_calls_are_coalesced():
+    async def scenario():
+        flight, calls = SingleFlight(), []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'answer'
+
+        results = await asyncio.gather(*(flight.do('key', compute) for _ in range(5)))
+        return flight, calls, results
+
+    flight, calls, results = run(scenario())
+    assert results == ['answer'] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {'in_flight': 0, 'started': 1, 'coalesced': 4}
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    async def scenario():
+        flight, release = SingleFlight(), asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return 'answer'
+
+        leader = asyncio.ensure_future(flight.do('key', compute))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do('key', compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return leader, await follower
+
+    leader, result = run(scenario())
+    assert leader.cancelled()
+    assert result == 'answer'
+
+
+def test_task_is_cancelled_when_nobody_waits():
+    async def scenario():
+        flight, cancelled = SingleFlight(), asyncio.Event()
+
+        async def compute():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.ensure_future(flight.do('key', compute))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return flight
+
+    flight = run(scenario())
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_error_reaches_every_waiter_and_frees_the_key():
+    async def scenario():
+        flight, attempts = SingleFlight(), []
+
+        async def fail():
+            attempts.append(1)
+            await asyncio.sleep(0.01)
+            raise RuntimeError('upstream is down')
+
+        results = await asyncio.gather(*(flight.do('key', fail) for _ in range(3)), return_exceptions=True)
+
+        async def succeed():
+            return 'retried'
+
+        return results, attempts, await flight.do('key', succeed)
+
+    results, attempts, retried = run(scenario())
+    assert len(attempts) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert retried == 'retried'
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flight = SingleFlight()
+
+        async def compute(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        return await asyncio.gather(flight.do('a', lambda: compute(1)), flight.do('b', lambda: compute(2)))
+
+    assert run(scenario()) == [1, 2]
+
+
+def test_factory_error_is_raised_to_caller():
+    async def scenario():
+        async def fail():
+            raise ValueError('bad question')
+
+        await SingleFlight().do('key', fail)
+
+    with pytest.raises(ValueError):
+        run(scenario())
@@ -0,0 +1,17 @@
+from utils.keyword_windows import question_terms
+from utils.terms import stem, tokenize
+
+
+def test_stem_cuts_endings_but_keeps_five_letters():
+    assert stem('кампуса') == 'кампу'
+    assert stem('кампус') == 'кампу'
+    assert stem('итмо') == 'итмо'
+
+
+def test_tokenize_drops_stop_words_and_short_tokens():
+    assert tokenize('Какой кампус у университета ИТМО в СПб?') == ['кампу', 'спб']
+
+
+def test_question_terms_use_the_same_stems():
+    question = 'Где находится кампус университета ИТМО?\n1. Кронверкский проспект\n2. Ломоносова'
+    assert set(question_terms(question)) <= set(tokenize(question))
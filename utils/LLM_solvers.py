@@ -1,32 +1,37 @@
-import asyncio
-import json
+import os
 from abc import ABC, abstractmethod
-from typing import List, Dict, Union
+from typing import Any, Awaitable, Callable, List, Dict, Optional
 
+import grpc
 from pydantic import BaseModel, Field, PrivateAttr
-from yandex_cloud_ml_sdk import YCloudML
 from yandex_cloud_ml_sdk._models import Models
 
 from schemas.request import PredictionResponse
+from utils.batch import BatchPlan
 from utils.cleanup import get_cleanup_prompt
-from utils.data_retrival_util import process_all_sources
-from utils.exceptions import LLMWorkflowError
+from utils.context_builder import build_context
+from utils.data_retrival_util import dumb_parse, process_all_sources, SOURCE_CANDIDATES, SOURCE_WANTED
+from utils.deadline import Deadline, DEADLINE_FINAL_RESERVE
+from utils.exceptions import DeadlineExceeded, LLMWorkflowError, RateLimited
+from utils.json_repair import extract_json, DIRECT_SCHEMA, FINAL_SCHEMA, QUERY_SCHEMA
+from utils.metrics import (span, CASCADE_ANSWERS, CLEANUP_FALLBACKS, DIRECT_ANSWERS, DIRECT_CONFIDENCE, JSON_RECOVERY,
+                           LOCAL_RETRIEVAL, RETRIED_STAGES)
+from utils.rate_limit import run_model, PRIORITY_FINAL, PRIORITY_QUERY
+from utils.resources import load_prompts, Prompts, Resources
+from utils.retrieval_index import get_index, INDEX_MIN_SCORE, INDEX_TOP_K
 from utils.search import get_search_urls
 
 
-with open('utils/prompts/base_instruct.xml') as base_instructions:
-    BASE_INSTRUCTIONS = base_instructions.read()
-
-with open('utils/prompts/after_search_instruct.xml') as after_search_instructions:
-    AFTER_SEARCH_TEMPLATE = after_search_instructions.read()
-
-
 class AbstractPredictionResponse(BaseModel, ABC):
     query_id: int = Field(..., description="Query ID")
     question: str = Field(..., description="Question from request")
+    prompts: Prompts = Field(default_factory=load_prompts, description="Prompt templates")
 
     def __init__(self, **data):
         super().__init__(**data)
+        self._reset_messages()
+
+    def _reset_messages(self) -> None:
         self._messages = self.__get_initial_instructions
 
     @property
@@ -34,7 +39,7 @@ class AbstractPredictionResponse(BaseModel, ABC):
         return [
             {
                 "role": "system",
-                "text": BASE_INSTRUCTIONS,
+                "text": self.prompts.base_instructions,
             },
             {
                 "role": "user",
@@ -50,64 +55,289 @@ class AbstractPredictionResponse(BaseModel, ABC):
         arbitrary_types_allowed = True  # для удовлетворения lsp PyCharm'а
 
 
+# Сколько раз можно повторить каждую стадию workflow, прежде чем сдаться
+STAGE_RETRIES = {
+    'local': 1,
+    'direct': 1,
+    'query': 3,
+    'search': 2,
+    'sources': 2,
+    'final': 4,
+}
+
+# Каскад моделей: сначала дешевый ответ без поиска, поиск и скрейпинг - только если модель не уверена
+CASCADE_DIRECT_ANSWER = os.getenv('CASCADE_DIRECT_ANSWER', '1').lower() in ('1', 'true', 'yes')
+CASCADE_CONFIDENCE_THRESHOLD = float(os.getenv('CASCADE_CONFIDENCE_THRESHOLD', 0.85))
+# после скольких неразобранных финальных ответов lite модели финальный ответ пишет сильная модель
+CASCADE_STRONG_AFTER = int(os.getenv('CASCADE_STRONG_AFTER', 2))
+
+
 class YaGPTResponse(AbstractPredictionResponse):
-    sdk: YCloudML = Field(..., description="YaGPT SDK with credentials")
-    temperature: float = Field(default=0.5, description="LLM temperature")
-    search_api_key: str = Field(..., description="Yandex search API key")
+    resources: Resources = Field(..., description="SDK, model handles and credentials shared by the worker")
+    stage_retries: Dict[str, int] = Field(default_factory=lambda: dict(STAGE_RETRIES),
+                                          description="Retry budget per workflow stage")
+    plan: Optional[BatchPlan] = Field(default=None, description="Search and fetch shared across a batch of questions")
+    deadline: Optional[Deadline] = Field(default=None, description="Latency budget shared by all workflow stages")
+    direct_answer: bool = Field(default=CASCADE_DIRECT_ANSWER, description="Try to answer without retrieval first")
+    confidence_threshold: float = Field(default=CASCADE_CONFIDENCE_THRESHOLD,
+                                        description="Minimal self-reported confidence to accept a direct answer")
+    strong_after: int = Field(default=CASCADE_STRONG_AFTER,
+                              description="Unparsed final answers before the stronger model takes over")
+    progress: Optional[Callable[[str, Any], Awaitable[None]]] = Field(
+        default=None,
+        description="Called with the stage name and its result after each stage that produced a non-empty "
+                    "result and after each source summary")
 
     _sources_links: List[str] = PrivateAttr()
+    _checkpoints: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    _stage_attempts: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _final_parse_failures: int = PrivateAttr(default=0)
+    _tier: str = PrivateAttr(default='')
 
     async def answer(self) -> PredictionResponse:
         """
-        Точка входа в workflow, отсюда класс управляет собой сам
+        Точка входа в workflow, отсюда класс управляет собой сам.
+        Workflow разбит на стадии, результат каждой запоминается, поэтому
+        повторный вызов (или ретрай упавшей стадии) не перезапускает
+        уже пройденные шаги
         """
+        if self.deadline is None:
+            self.deadline = Deadline()
+
         # models
-        ya_gpt = self.sdk.models.completions('yandexgpt-lite').configure(temperature=self.temperature, max_tokens=32000)
-        error_handler = self.sdk.models.completions('yandexgpt-lite')
+        self._ya_gpt = self.resources.answer_model
+        self._error_handler = self.resources.cleanup_model
 
-        # 1 step: get data sources
-        dirty_data_request = self.__get_initial_data_request(ya_gpt)
-        query_string = self.__handle_invalid_format(dirty_data_request, error_handler)
+        # 0 step: local index, if it is confident enough, search and scraping are skipped
+        scraped_data = await self._run_stage('local', self.__local_sources)
+        if scraped_data:
+            self._sources_links = list(scraped_data)
+            self._tier = 'local'
+        else:
+            # 1 step: cheap direct answer, retrieval runs only if the model is not confident
+            direct = await self.__try_direct_answer()
+            if direct is not None:
+                self._tier = 'direct'
+                CASCADE_ANSWERS.inc(tier=self._tier)
+                return direct
 
-        self._sources_links = get_search_urls(query_string,
-                                              folder_id=self.sdk._folder_id,
-                                              api_key=self.search_api_key)[:4]
+            # 2 step: get data sources
+            query_string = await self._run_stage('query', self.__generate_query)
+            self._sources_links = await self._run_stage('search', self.__search_sources, query_string)
 
-        # 2 step: scrape data from sources
-        future = asyncio.create_task(process_all_sources(self._sources_links, self.sdk, self.question))
-        scraped_data = await future
-        after_search_instructions = AFTER_SEARCH_TEMPLATE.replace('{{ question_text }}', self.question)
+            # 3 step: scrape data from sources
+            scraped_data = await self._run_stage('sources', self.__scrape_sources)
+            self._tier = 'retrieval'
 
-        self._messages = [{
+        # 4 step: get final answer
+        response = await self._run_stage('final', self.__final_answer, scraped_data)
+        CASCADE_ANSWERS.inc(tier=self._tier)
+        return response
+
+    @property
+    def tier(self) -> str:
+        """Ступень каскада, которая дала ответ: direct, local, retrieval или strong"""
+        return self._tier
+
+    @property
+    def stage_attempts(self) -> Dict[str, int]:
+        """Сколько попыток потребовалось каждой стадии"""
+        return dict(self._stage_attempts)
+
+    async def _run_stage(self, name: str, stage: Callable[..., Awaitable[Any]], *args) -> Any:
+        """
+        Выполняет стадию с учетом ее бюджета ретраев и запоминает результат
+        """
+        if name in self._checkpoints:
+            return self._checkpoints[name]
+
+        last_error = None
+        while self._stage_attempts.get(name, 0) < self.stage_retries.get(name, 1):
+            self.deadline.check(name)
+            self._stage_attempts[name] = self._stage_attempts.get(name, 0) + 1
+            try:
+                result = await stage(*args)
+            except (DeadlineExceeded, RateLimited):
+                # ретрай после дедлайна или исчерпанных ретраев троттлинга бесполезен
+                raise
+            except (LLMWorkflowError, ValueError) as e:
+                RETRIED_STAGES.inc(stage=name)
+                last_error = e
+                continue
+            self._checkpoints[name] = result
+            if result:
+                # пустой индекс или отказ от прямого ответа - не прогресс, о таких стадиях не сообщаем
+                await self._report(name, result)
+            return result
+
+        raise LLMWorkflowError(f'Stage {name} failed after {self._stage_attempts.get(name, 0)} attempts: {last_error}')
+
+    async def _report(self, stage: str, result: Any) -> None:
+        """Сообщает о завершенной стадии; ошибка наблюдателя не должна ронять workflow"""
+        if self.progress is None:
+            return
+        try:
+            await self.progress(stage, result)
+        except Exception:
+            pass
+
+    async def __local_sources(self) -> Dict[str, str]:
+        """
+        Пассажи из локального индекса, сгруппированные по url. Пустой
+        результат, если индекса нет или лучшая оценка ниже порога
+        """
+        with span('local_search'):
+            try:
+                index = get_index()
+                passages = index.search(self.question, INDEX_TOP_K) if index is not None else []
+            except (OSError, ValueError, KeyError):
+                index, passages = None, []
+        if index is None:
+            LOCAL_RETRIEVAL.inc(result='no_index')
+            return {}
+        if not passages or passages[0].score < INDEX_MIN_SCORE:
+            LOCAL_RETRIEVAL.inc(result='fallback')
+            return {}
+
+        LOCAL_RETRIEVAL.inc(result='hit')
+        sources: Dict[str, str] = {}
+        for passage in passages:
+            if passage.score >= INDEX_MIN_SCORE / 2 and (passage.url in sources or len(sources) < 4):
+                sources[passage.url] = f'{sources[passage.url]}\n{passage.text}' if passage.url in sources else passage.text
+        return sources
+
+    async def __try_direct_answer(self) -> Optional[PredictionResponse]:
+        """
+        Прямой ответ одним вызовом lite модели. None, если каскад выключен,
+        ответ не разобрался или модель в нем не уверена - тогда дальше
+        работает обычный путь через поиск
+        """
+        if not self.direct_answer:
+            return None
+        try:
+            return await self._run_stage('direct', self.__direct_answer)
+        except (DeadlineExceeded, RateLimited):
+            raise
+        except LLMWorkflowError:
+            DIRECT_ANSWERS.inc(result='failed')
+            return None
+
+    async def __direct_answer(self) -> Optional[PredictionResponse]:
+        messages = [{
             "role": "system",
-            'text': f"{after_search_instructions}\n",
+            "text": self.prompts.direct_answer(self.question),
         }, {
-            "role": 'user',
-            "text": f"# Факты и источники\n{scraped_data}\nОтветь на мой вопрос: {self.question}",
+            "role": "user",
+            "text": self.question,
         }]
+        with span('direct_answer'):
+            model_response = await self.deadline.run(
+                run_model(self.resources.direct_model, messages, PRIORITY_QUERY),
+                'direct', reserve=DEADLINE_FINAL_RESERVE)
 
-        # 3 step: get final answer
-        dirty_response = ya_gpt.run(self._messages)[0].text
-        clean_response = self.__parse_invalid_final_response(dirty_response, error_handler)
-        answer = clean_response['answer']
+        # без cleanup llm: если ответ не разобрался, дешевле сразу пойти в поиск
+        json_object, path = extract_json(model_response[0].text, DIRECT_SCHEMA, required=('answer', 'confidence'))
+        JSON_RECOVERY.inc(kind='direct', path=path)
+        if json_object is None:
+            raise LLMWorkflowError('Direct answer has no valid json')
 
-        if type(answer) == str and answer.isalnum():
-            answer = int(answer)
-        if type(answer) != int:
-            answer = -1
+        confidence = json_object['confidence']
+        # модели иногда пишут уверенность в процентах
+        confidence = confidence / 100 if confidence > 1 else confidence
+        DIRECT_CONFIDENCE.observe(confidence)
+        if json_object['answer'] == -1 or confidence < self.confidence_threshold:
+            DIRECT_ANSWERS.inc(result='low_confidence')
+            return None
 
+        DIRECT_ANSWERS.inc(result='accepted')
         return PredictionResponse(
             id=self.query_id,
-            answer=answer,
-            reasoning=clean_response['reasoning'],
-            sources=clean_response['sources'][:3],
+            answer=json_object['answer'],
+            reasoning=json_object['reasoning'],
+            sources=[source for source in json_object['sources'] if source.startswith('http')][:3],
         )
 
-    def __get_initial_data_request(self, model: BaseModel) -> str:
+    async def __generate_query(self) -> str:
+        self._reset_messages()
+        with span('query_generation'):
+            dirty_data_request = await self.deadline.run(self.__get_initial_data_request(self._ya_gpt),
+                                                         'query', reserve=DEADLINE_FINAL_RESERVE)
+        return await self.__handle_invalid_format(dirty_data_request, self._error_handler)
+
+    async def __search_sources(self, query_string: str) -> List[str]:
+        search = self.plan.search_urls if self.plan is not None else get_search_urls
+        with span('search'):
+            urls = await self.deadline.run(search(query_string,
+                                                  folder_id=self.resources.folder_id,
+                                                  api_key=self.resources.search_api_key),
+                                           'search', reserve=DEADLINE_FINAL_RESERVE)
+        # кандидатов больше, чем нужно: медленные и пустые страницы отсеются при скачивании
+        return urls[:SOURCE_CANDIDATES]
+
+    async def __scrape_sources(self) -> Dict[str, str]:
+        with span('sources'):
+            return await process_all_sources(self._sources_links, self.resources.summary_model, self.question,
+                                             fetch=self.plan.fetch if self.plan is not None else dumb_parse,
+                                             wanted=SOURCE_WANTED, deadline=self.deadline,
+                                             on_summary=self.__report_summary)
+
+    async def __report_summary(self, url: str, summary: str) -> None:
+        await self._report('summary', {'url': url, 'summary': summary})
+
+    async def __generate_final_response(self, scraped_data: Dict[str, str]) -> str:
+        after_search_instructions = self.prompts.after_search(self.question)
+
+        self._messages = [{
+            "role": "system",
+            'text': f"{after_search_instructions}\n",
+        }, {
+            "role": 'user',
+            "text": f"# Факты и источники\n{build_context(self.question, scraped_data)}\n"
+                    f"Ответь на мой вопрос: {self.question}",
+        }]
+        model = self._ya_gpt
+        if self._final_parse_failures >= self.strong_after:
+            # lite модель несколько раз подряд не справилась с форматом
+            model, self._tier = self.resources.strong_model, 'strong'
+        with span('final_answer'):
+            model_response = await self.deadline.run(run_model(model, self._messages, PRIORITY_FINAL), 'final')
+        return model_response[0].text
+
+    async def __final_answer(self, scraped_data: Dict[str, str]) -> PredictionResponse:
+        dirty_response = self._checkpoints.get('final_raw')
+        if dirty_response is None:
+            dirty_response = await self.__generate_final_response(scraped_data)
+            self._checkpoints['final_raw'] = dirty_response
+
+        try:
+            clean_response = await self.__parse_invalid_final_response(dirty_response, self._error_handler)
+            return PredictionResponse(
+                id=self.query_id,
+                answer=clean_response['answer'],
+                reasoning=clean_response['reasoning'],
+                sources=clean_response['sources'][:3],
+            )
+        except grpc.RpcError as e:
+            # упал вызов cleanup модели, а не сам ответ: сырой ответ остается в checkpoint,
+            # и ретрай стадии повторит только разбор, без новой генерации
+            raise LLMWorkflowError(f'Cleanup of the final response failed: {e}')
+        except (KeyError, TypeError) as e:
+            self._checkpoints.pop('final_raw', None)
+            self._final_parse_failures += 1
+            raise LLMWorkflowError(f'Final response has invalid schema: {e}')
+        except (DeadlineExceeded, RateLimited):
+            raise
+        except (LLMWorkflowError, ValueError):
+            # сырой ответ не удалось разобрать, следующая попытка сгенерирует новый
+            self._checkpoints.pop('final_raw', None)
+            self._final_parse_failures += 1
+            raise
+
+    async def __get_initial_data_request(self, model: BaseModel) -> str:
         """
         Приватная функция, получает из llm запрос на данные в поисковике
         """
-        model_response = model.run(self._messages)
+        model_response = await run_model(model, self._messages, PRIORITY_QUERY)
         self._messages.append({
             'role': 'assistant',
             'text': model_response[0].text,
@@ -115,72 +345,46 @@ class YaGPTResponse(AbstractPredictionResponse):
 
         return model_response[0].text
 
-    def __handle_invalid_format(self, response: str, error_handler: Models) -> str:
+    async def __handle_invalid_format(self, response: str, error_handler: Models) -> str:
         """
         Приватная функция для извлечения поискового запроса из ответа llm
         """
-        # 1 step: try naive approaches to extract json
-        try:
-            _, dirty_schema = response.split('---')
-        except ValueError:
-            guess_start = response.rfind('{')
-            if guess_start == -1:
-                dirty_schema = ''
-            else:
-                dirty_schema = response[guess_start:]
-
-        # step 2: mix in a light llm to fix it for us
-        if not dirty_schema:
-            prompt = get_cleanup_prompt(schema="""{"query": "query_text"}""", dirty_text=response)
-            model_response = error_handler.run(prompt)
-            dirty_schema = model_response[0].text
-
-        # step 3: second naive pass
-        guess_start = dirty_schema.rfind('{')
-        guess_end = dirty_schema.rfind('}')
-        if guess_start == -1:
-            dirty_schema = ''
-        else:
-            dirty_schema = dirty_schema[guess_start:guess_end + 1]
-
-        # step 4: convert the possible text into a valid json, else restart the process
-        try:
-            json_object = json.loads(dirty_schema)
-            return json_object['query']
-        except json.decoder.JSONDecodeError:
-            raise LLMWorkflowError('Failed to create a valid request')
+        json_object = await self.__recover_json('query', response, QUERY_SCHEMA, error_handler,
+                                                 """{"query": "query_text"}""", PRIORITY_QUERY,
+                                                 reserve=DEADLINE_FINAL_RESERVE)
+        return json_object['query']
 
-    def __parse_invalid_final_response(self, response: str, error_handler: Models) -> Dict[str, Union[str, List[str]]]:
+    async def __parse_invalid_final_response(self, response: str, error_handler: Models) -> Dict[str, Any]:
         """
         Приватная функция для парсинга вывода workflow в валидную json схему
         """
-        # 1 step: try naive approaches to extract json
-        try:
-            _, dirty_schema = response.split('---')
-        except ValueError:
-            guess_start = response.rfind('{')
-            guess_end = response.rfind('}')
-            if guess_start == -1:
-                dirty_schema = ''
-            else:
-                dirty_schema = response[guess_start:guess_end + 1]
+        return await self.__recover_json('final', response, FINAL_SCHEMA, error_handler,
+                                         """{"answer": "text", "reasoning": "text", "sources": ["text", "text"]}""",
+                                         PRIORITY_FINAL)
+
+    async def __recover_json(self, kind: str, response: str, schema: Dict[str, type], error_handler: Models,
+                             prompt_schema: str, priority: int, reserve: float = 0.0) -> Dict[str, Any]:
+        """
+        Достает из ответа llm объект нужной схемы: сначала локально (json
+        целиком, затем с ремонтом кавычек, запятых и обрезанного хвоста),
+        и только если не вышло - через вспомогательную llm. Иначе стадия
+        перезапускается
+        """
+        # step 1: local tolerant parsing
+        json_object, path = extract_json(response, schema)
 
         # step 2: mix in a light llm to fix it for us
-        if not dirty_schema:
-            prompt = get_cleanup_prompt(
-                schema="""{"answer": "text", "reasoning": "text", "sources": ["text", "text"]}""", dirty_text=response)
-            model_response = error_handler.run(prompt)
-            dirty_schema = model_response[0].text
-
-        # step 3: second naive pass
-        guess_start = dirty_schema.rfind('{')
-        guess_end = dirty_schema.rfind('}')
-        if guess_start == -1:
-            dirty_schema = ''
-        else:
-            dirty_schema = dirty_schema[guess_start:guess_end + 1]
-        # step 4: convert the possible text into a valid json, else restart the process
-        try:
-            return json.loads(dirty_schema)
-        except json.decoder.JSONDecodeError:
+        if json_object is None:
+            prompt = get_cleanup_prompt(schema=prompt_schema, dirty_text=response)
+            CLEANUP_FALLBACKS.inc(kind=kind)
+            with span(f'cleanup_{kind}'):
+                model_response = await self.deadline.run(run_model(error_handler, prompt, priority),
+                                                         f'cleanup_{kind}', reserve=reserve)
+            json_object, path = extract_json(model_response[0].text, schema)
+            path = 'cleanup_llm' if json_object is not None else 'failed'
+
+        JSON_RECOVERY.inc(kind=kind, path=path)
+        # step 3: restart the stage if nothing helped
+        if json_object is None:
             raise LLMWorkflowError('Failed to create a valid request')
+        return json_object
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from typing import Optional
+
+from utils.metrics import start_timings, server_timing
+
+ACCESS_LOG_PATH = os.getenv('ACCESS_LOG_PATH', 'logs/access.jsonl')
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv('ACCESS_LOG_SAMPLE_RATE', 1.0))
+ACCESS_LOG_BODY_LIMIT = int(os.getenv('ACCESS_LOG_BODY_LIMIT', 2048))
+ACCESS_LOG_QUEUE_SIZE = int(os.getenv('ACCESS_LOG_QUEUE_SIZE', 10000))
+ACCESS_LOG_MAX_BYTES = int(os.getenv('ACCESS_LOG_MAX_BYTES', 50 * 1024 * 1024))
+ACCESS_LOG_BACKUPS = int(os.getenv('ACCESS_LOG_BACKUPS', 3))
+ACCESS_LOG_STDOUT = os.getenv('ACCESS_LOG_STDOUT', '0').lower() in ('1', 'true', 'yes')
+ACCESS_LOG_TIMINGS = os.getenv('ACCESS_LOG_TIMINGS', '1').lower() in ('1', 'true', 'yes')
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', '0').lower() in ('1', 'true', 'yes')
+
+
+class JsonLineWriter:
+    """
+    Пишет структурированные записи json строками через ограниченную очередь.
+    Если очередь переполнена, запись выбрасывается, а не блокирует запрос.
+    Файл ротируется по размеру
+    """
+
+    def __init__(self,
+                 path: str = ACCESS_LOG_PATH,
+                 queue_size: int = ACCESS_LOG_QUEUE_SIZE,
+                 max_bytes: int = ACCESS_LOG_MAX_BYTES,
+                 backups: int = ACCESS_LOG_BACKUPS,
+                 stdout: bool = ACCESS_LOG_STDOUT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.stdout = stdout
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def write(self, record: dict) -> bool:
+        if self._queue is None:
+            self.dropped += 1
+            return False
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    def start(self) -> None:
+        """Запускает фоновую запись, очередь создается внутри event loop воркера"""
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < 512:
+                batch.append(self._queue.get_nowait())
+            lines = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in batch)
+            try:
+                await asyncio.to_thread(self._write_lines, lines)
+            except OSError as e:
+                print(f'access log write failed: {e}', file=sys.stderr)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_lines(self, lines: str) -> None:
+        if self.stdout:
+            sys.stdout.write(lines)
+            sys.stdout.flush()
+        if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+        with open(self.path, 'a', encoding='utf-8') as log_file:
+            log_file.write(lines)
+
+    def _rotate(self) -> None:
+        for index in range(self.backups - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+
+class AccessLogMiddleware:
+    """
+    ASGI middleware для логирования запросов без буферизации тел:
+    сообщения receive/send пробрасываются как есть, а в лог копируется
+    только первые body_limit байт. Логируется доля запросов sample_rate,
+    ответы 5xx и исключения пишутся всегда. Разбивка по стадиям пайплайна
+    из utils.metrics добавляется в запись и, по желанию, в Server-Timing
+    """
+
+    def __init__(self, app, writer: JsonLineWriter,
+                 sample_rate: float = ACCESS_LOG_SAMPLE_RATE,
+                 body_limit: int = ACCESS_LOG_BODY_LIMIT,
+                 log_timings: bool = ACCESS_LOG_TIMINGS,
+                 timing_header: bool = SERVER_TIMING_HEADER):
+        self.app = app
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.body_limit = body_limit
+        self.log_timings = log_timings
+        self.timing_header = timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        sampled = random.random() < self.sample_rate
+        started = time.perf_counter()
+        request_body, response_body = bytearray(), bytearray()
+        state = {'status': None, 'request_size': 0, 'response_size': 0}
+        timings = start_timings()
+
+        async def receive_wrapper():
+            message = await receive()
+            if message['type'] == 'http.request':
+                chunk = message.get('body', b'')
+                state['request_size'] += len(chunk)
+                if sampled and len(request_body) < self.body_limit:
+                    request_body.extend(chunk[:self.body_limit - len(request_body)])
+            return message
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                state['status'] = message['status']
+                if self.timing_header and timings:
+                    headers = list(message.get('headers', [])) + [(b'server-timing', server_timing(timings).encode())]
+                    message = {**message, 'headers': headers}
+            elif message['type'] == 'http.response.body':
+                chunk = message.get('body', b'')
+                state['response_size'] += len(chunk)
+                if sampled and len(response_body) < self.body_limit:
+                    response_body.extend(chunk[:self.body_limit - len(response_body)])
+            await send(message)
+
+        error = None
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            status = state['status'] or 500
+            if sampled or status >= 500 or error:
+                record = {
+                    'ts': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                    'method': scope['method'],
+                    'path': scope['path'],
+                    'query': scope.get('query_string', b'').decode('latin-1'),
+                    'status': status,
+                    'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+                    'request_size': state['request_size'],
+                    'response_size': state['response_size'],
+                }
+                if sampled:
+                    record['request_body'] = request_body.decode('utf-8', errors='replace')
+                    record['response_body'] = response_body.decode('utf-8', errors='replace')
+                    record['truncated'] = (state['request_size'] > self.body_limit
+                                           or state['response_size'] > self.body_limit)
+                if self.log_timings and timings:
+                    record['timings'] = timings
+                if error:
+                    record['error'] = error
+                self.writer.write(record)
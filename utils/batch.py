@@ -0,0 +1,64 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List
+
+from utils.data_retrival_util import dumb_parse
+from utils.metrics import BATCH_DEDUPLICATED
+from utils.questions import normalize_text
+from utils.search import get_search_urls
+
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 100))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 8))
+
+
+class BatchPlan:
+    """
+    Общие для пакета вопросов поиск и скачивание страниц: одинаковые
+    поисковые запросы выполняются один раз, а каждая страница скачивается
+    один раз на весь пакет, сколько бы вопросов на нее ни ссылались.
+    Неудачные вызовы не запоминаются, чтобы ретраи стадий шли заново
+    """
+
+    def __init__(self):
+        self._searches: Dict[str, asyncio.Future] = {}
+        self._pages: Dict[str, asyncio.Future] = {}
+        self.saved = {'search': 0, 'fetch': 0}
+        self.closed = False
+
+    def _shared(self, kind: str, memo: Dict[str, asyncio.Future], key: str,
+                factory: Callable[[], Awaitable[Any]]) -> Awaitable[Any]:
+        task = memo.get(key)
+        if task is None:
+            task = memo[key] = asyncio.ensure_future(factory())
+
+            def forget_failed(done: asyncio.Future) -> None:
+                if (done.cancelled() or done.exception() is not None) and memo.get(key) is done:
+                    del memo[key]
+
+            task.add_done_callback(forget_failed)
+        else:
+            self.saved[kind] += 1
+            BATCH_DEDUPLICATED.inc(kind=kind)
+        # отмена одного вопроса не должна отменять общий для пакета вызов
+        return asyncio.shield(task)
+
+    async def search_urls(self, query: str, folder_id: str, api_key: str) -> List[str]:
+        return await self._shared('search', self._searches, normalize_text(query),
+                                  lambda: get_search_urls(query, folder_id=folder_id, api_key=api_key))
+
+    async def fetch(self, url: str) -> str:
+        return await self._shared('fetch', self._pages, url, lambda: dumb_parse(url))
+
+    def close(self) -> None:
+        """Отменяет то, что еще выполняется, когда пакет уже не нужен"""
+        self.closed = True
+        for task in list(self._searches.values()) + list(self._pages.values()):
+            task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'searches': len(self._searches),
+            'pages': len(self._pages),
+            'saved_searches': self.saved['search'],
+            'saved_fetches': self.saved['fetch'],
+        }
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """
+    Открывает sqlite файл для совместного использования воркерами:
+    autocommit, WAL и ожидание блокировки вместо ошибки
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class ProcessLocalConnection:
+    """
+    sqlite соединение, которое открывается лениво и отдельно в каждом
+    процессе. Под gunicorn --preload кэши создаются в мастере до fork,
+    а открытое соединение sqlite через fork переносить нельзя
+    """
+
+    def __init__(self, path: str, setup: Callable[[sqlite3.Connection], None]):
+        self.path = path
+        self._setup = setup
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+    def get(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = connect_sqlite(self.path)
+            self._setup(conn)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+class MemoryLRU:
+    """
+    In-process LRU кэш с TTL. Живет внутри одного воркера,
+    поэтому отвечает за миллисекундные попадания
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SqliteKV:
+    """
+    Персистентный key-value поверх sqlite. Файл общий для всех
+    воркеров gunicorn, WAL режим позволяет им читать параллельно
+    """
+
+    def __init__(self, path: str, table: str = 'kv', ttl: float = 3600, max_rows: int = 100_000):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._db = ProcessLocalConnection(path, self._create_table)
+
+    def _create_table(self, conn: sqlite3.Connection) -> None:
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed_at)')
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT value, expires_at FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                return None
+            self._conn.execute(f'UPDATE {self.table} SET accessed_at = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), expires_at, now),
+            )
+            self._evict(now)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute(f'DELETE FROM {self.table} WHERE expires_at < ?', (now,))
+        overflow = self._conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0] - self.max_rows
+        if overflow > 0:
+            self._conn.execute(
+                f'DELETE FROM {self.table} WHERE key IN '
+                f'(SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)', (overflow,)
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class TieredCache:
+    """
+    Двухуровневый кэш: LRU в памяти воркера и опциональный
+    sqlite файл, который переживает рестарты и общий для воркеров.
+    Значения должны сериализоваться в json
+    """
+
+    def __init__(self, memory: MemoryLRU, persistent: Optional[SqliteKV] = None):
+        self.memory = memory
+        self.persistent = persistent
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is None and self.persistent is not None:
+            value = await asyncio.to_thread(self.persistent.get, key)
+            if value is not None:
+                self.memory.set(key, value)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+        if self.persistent is not None:
+            await asyncio.to_thread(self.persistent.set, key, value)
+
+    async def delete(self, key: str) -> None:
+        self.memory.delete(key)
+        if self.persistent is not None:
+            await asyncio.to_thread(self.persistent.delete, key)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'memory_size': len(self.memory),
+        }
+
+
+def build_cache(prefix: str, maxsize: int, ttl: float, path: Optional[str] = None) -> TieredCache:
+    """
+    Собирает TieredCache из переменных окружения вида {prefix}_SIZE,
+    {prefix}_TTL и {prefix}_PATH. Пустой путь отключает персистентный слой
+    """
+    maxsize = int(os.getenv(f'{prefix}_SIZE', maxsize))
+    ttl = float(os.getenv(f'{prefix}_TTL', ttl))
+    path = os.getenv(f'{prefix}_PATH', path or '')
+
+    persistent = SqliteKV(path, table=prefix.lower(), ttl=ttl) if path else None
+    return TieredCache(MemoryLRU(maxsize=maxsize, ttl=ttl), persistent)
@@ -0,0 +1,126 @@
+import math
+import os
+import re
+from typing import Dict, List, NamedTuple, Set
+
+from utils.metrics import CONTEXT_TOKENS
+from utils.questions import split_options
+from utils.terms import tokenize
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 3000))
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv('CONTEXT_CHARS_PER_TOKEN', 4))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv('CONTEXT_DUPLICATE_THRESHOLD', 0.8))
+SNIPPET_TOKENS = 120
+# варианты ответа различают гипотезы, поэтому их слова весят больше слов формулировки
+OPTION_WEIGHT = 1.5
+
+WORD_PATTERN = re.compile(r'\w+')
+TOKEN_PIECE_PATTERN = re.compile(r'\w+|[^\w\s]')
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?;])\s+')
+
+
+class Snippet(NamedTuple):
+    source: int
+    position: int
+    text: str
+    tokens: int
+    score: float
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без обращения к api: длинные слова
+    токенизатор режет на части примерно по CONTEXT_CHARS_PER_TOKEN
+    символов, каждый знак препинания - отдельный токен
+    """
+    return sum(math.ceil(len(piece) / CONTEXT_CHARS_PER_TOKEN) for piece in TOKEN_PIECE_PATTERN.findall(text))
+
+
+def truncate_tokens(text: str, budget: int) -> str:
+    """Обрезает текст по границе слова так, чтобы он уложился в budget токенов"""
+    if estimate_tokens(text) <= budget:
+        return text
+    used = 0
+    for match in TOKEN_PIECE_PATTERN.finditer(text):
+        used += math.ceil(len(match.group(0)) / CONTEXT_CHARS_PER_TOKEN)
+        if used > budget:
+            return text[:match.start()].rstrip()
+    return text
+
+
+def split_snippets(text: str, max_tokens: int = SNIPPET_TOKENS) -> List[str]:
+    """Режет текст источника на фрагменты: по строкам, длинные строки - по предложениям"""
+    snippets = []
+    for line in filter(None, (line.strip() for line in text.splitlines())):
+        current, size = [], 0
+        for sentence in SENTENCE_PATTERN.split(line):
+            tokens = estimate_tokens(sentence)
+            if current and size + tokens > max_tokens:
+                snippets.append(' '.join(current))
+                current, size = [], 0
+            current.append(sentence)
+            size += tokens
+        if current:
+            snippets.append(' '.join(current))
+    return [truncate_tokens(snippet, max_tokens) for snippet in snippets]
+
+
+def shingles(text: str, size: int = 3) -> Set[int]:
+    words = WORD_PATTERN.findall(text.lower())
+    return {hash(tuple(words[index:index + size])) for index in range(max(1, len(words) - size + 1))}
+
+
+def relevance_weights(question: str) -> Dict[str, float]:
+    stem, options = split_options(question)
+    weights = {term: 1.0 for term in tokenize(stem)}
+    for _, text in options:
+        for term in tokenize(text):
+            weights[term] = max(weights.get(term, 0.0), OPTION_WEIGHT)
+    return weights
+
+
+def rank_snippets(question: str, sources: Dict[str, str]) -> List[Snippet]:
+    """
+    Фрагменты всех источников без почти-дубликатов (jaccard по шинглам),
+    отсортированные по совпадению с вопросом и вариантами ответа.
+    При равной оценке выше источник, который был выше в выдаче
+    """
+    weights = relevance_weights(question)
+    snippets, kept_shingles = [], []
+    for source, text in enumerate(sources.values()):
+        for position, snippet in enumerate(split_snippets(text or '')):
+            snippet_shingles = shingles(snippet)
+            if any(len(snippet_shingles & other) / len(snippet_shingles | other) >= CONTEXT_DUPLICATE_THRESHOLD
+                   for other in kept_shingles):
+                continue
+            kept_shingles.append(snippet_shingles)
+            terms = set(tokenize(snippet))
+            score = sum(weight for term, weight in weights.items() if term in terms)
+            snippets.append(Snippet(source, position, snippet, estimate_tokens(snippet), score))
+    return sorted(snippets, key=lambda snippet: (-snippet.score, snippet.source, snippet.position))
+
+
+def build_context(question: str, sources: Dict[str, str], budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Собирает факты для финального промпта: самые релевантные фрагменты,
+    уложенные в budget токенов, в порядке источников. Источник
+    указывается коротким номером [n], url перечислены один раз в начале
+    """
+    urls = list(sources)
+    selected, used = [], 0
+    for snippet in rank_snippets(question, sources):
+        if used + snippet.tokens + 2 <= budget:
+            selected.append(snippet)
+            used += snippet.tokens + 2
+    selected.sort(key=lambda snippet: (snippet.source, snippet.position))
+
+    labels: Dict[int, int] = {}
+    for snippet in selected:
+        labels.setdefault(snippet.source, len(labels) + 1)
+    lines = [f'[{label}] {urls[source]}' for source, label in labels.items()]
+    lines.append('')
+    lines.extend(f'[{labels[snippet.source]}] {snippet.text}' for snippet in selected)
+
+    context = '\n'.join(lines) if selected else ''
+    CONTEXT_TOKENS.observe(estimate_tokens(context))
+    return context
@@ -1,86 +1,114 @@
 import asyncio
-from typing import List, Dict
+import hashlib
+import os
+from typing import Awaitable, Callable, List, Dict, Optional, Tuple
 
 import aiohttp
-from bs4 import BeautifulSoup
-from yandex_cloud_ml_sdk import YCloudML
+
+from utils.cache import build_cache
+from utils.context_builder import CONTEXT_CHARS_PER_TOKEN, truncate_tokens
+from utils.deadline import Deadline, DEADLINE_FINAL_RESERVE
+from utils.html_extract import extract_text
+from utils.http_client import fetch_text
+from utils.keyword_windows import DEFAULT_KEYWORDS, extract_windows, question_terms
+from utils.metrics import span, DEADLINE_EXCEEDED, SCRAPES, SOURCES_DROPPED
+from utils.page_cache import page_cache, CachedPage
+from utils.questions import question_key
+from utils.rate_limit import run_model, PRIORITY_SUMMARY
+
+# сколько ссылок брать из выдачи поиска и сколько источников с найденными окнами достаточно для ответа
+SOURCE_CANDIDATES = int(os.getenv('SOURCE_CANDIDATES', 8))
+SOURCE_WANTED = int(os.getenv('SOURCE_WANTED', 4))
+# сколько токенов окон страницы отправлять в суммаризацию
+SUMMARY_INPUT_TOKENS = int(os.getenv('SUMMARY_INPUT_TOKENS', 2000))
+
+# страницы с этими статусами удалены: устаревшую копию из кэша отдавать нельзя
+GONE_STATUSES = (404, 410)
+
+summary_cache = build_cache('SUMMARY_CACHE', maxsize=2048, ttl=7 * 24 * 3600, path='cache/summaries.sqlite')
 
 
 async def dumb_parse(url: str) -> str:
-    """Асинхронно запрашивает html страницы и
-    парсит его в блок текста"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=10) as response:
-                if response.status != 200:
-                    return ""
-                content = await response.text(errors='replace')
-    except asyncio.TimeoutError:
-        return ''
-
-    return BeautifulSoup(content, 'html.parser').get_text(' ', strip=True).lower()
-
-
-def merge_sorted_indexes(list1, list2):
-    merged = []
-    i, j = 0, 0
-    while i < len(list1) and j < len(list2):
-        if list1[i] < list2[j]:
-            merged.append(list1[i])
-            i += 1
-        else:
-            merged.append(list2[j])
-            j += 1
-    merged.extend(list1[i:])
-    merged.extend(list2[j:])
-    return merged
-
-
-def find_all(a_str, sub):
-    start = 0
-    while True:
-        start = a_str.find(sub, start)
-        if start == -1: return
-        yield start
-        start += len(sub)
-
-
-def extract_surrounding(source: str, indexes: List[int], bound=100) -> str:
-    """Извлекает подстроки вокруг слов итмо"""
-    result = []
-    while indexes:
-        center = indexes.pop(0)
-        start, end = max(0, center - bound), min(len(source), center + bound)
-        while indexes and indexes[0] - (2 * bound) < end:
-            center = indexes.pop(0)
-            end = min(len(source), center + bound)
-        result.append(source[start:end])
-    return '\n'.join(result)
-
-
-async def bounds_based_parse(url: str, bound: int = 100) -> str:
+    """Асинхронно запрашивает html страницы через общий пул
+    соединений и парсит его в блок текста. Свежие страницы берутся
+    из кэша, устаревшие ревалидируются условным GET. Если сайт
+    недоступен (сеть, таймаут, 5xx и прочие ошибки), отдается
+    устаревшая копия: старые факты лучше, чем никаких. Только 404 и
+    410 означают, что страницы больше нет, и копия удаляется"""
+    with span('scrape'):
+        cached = await page_cache.get(url) if page_cache is not None else None
+        if cached is not None and cached.fresh:
+            SCRAPES.inc(result='cached')
+            return cached.text
+
+        try:
+            status, headers, content = await fetch_text(url, cached.conditional_headers() if cached else None)
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            return _stale(cached)
+
+        if status == 304 and cached is not None:
+            SCRAPES.inc(result='not_modified')
+            await page_cache.touch(url)
+            return cached.text
+        if status in GONE_STATUSES:
+            SCRAPES.inc(result='gone')
+            if cached is not None:
+                await page_cache.delete(url)
+            return ''
+        if status != 200:
+            return _stale(cached)
+        if not content:
+            SCRAPES.inc(result='empty')
+            return ''
+
+        text = await extract_text(content)
+        SCRAPES.inc(result='ok' if text else 'empty')
+        if page_cache is not None:
+            await page_cache.put(url, text, headers.get('ETag'), headers.get('Last-Modified'))
+        return text
+
+
+def _stale(cached: Optional[CachedPage]) -> str:
+    SCRAPES.inc(result='stale' if cached is not None else 'error')
+    return cached.text if cached is not None else ''
+
+
+def summary_key(data: str, context: str) -> str:
+    content_hash = hashlib.sha256(data.encode('utf-8')).hexdigest()
+    return f'{content_hash}:{question_key(context)}'
+
+
+async def bounds_based_parse(url: str, bound: int = 100, keywords: Tuple[str, ...] = DEFAULT_KEYWORDS,
+                             limit: int = 0, fetch: Callable[[str], Awaitable[str]] = dumb_parse) -> str:
     """
     Наивный подход для извлечения контекстных данных:
-    берет 2 * bound символов вокруг слов итмо и itmo
+    берет окна по bound символов вокруг ключевых слов (итмо, itmo и т.п.)
     и возвращает одним текстовым блоком. Для классического
     nlp еще бы нормализовать, но llm не очень такое любит
     """
-    data = await dumb_parse(url)
-    indexes = merge_sorted_indexes(list(find_all(data, 'итмо')), list(find_all(data, 'itmo')))
-    surrounding = extract_surrounding(data, indexes, bound)
-    return surrounding
+    data = await fetch(url)
+    return extract_windows(data, keywords, bound, limit)
+
 
+async def source_windows(url: str, context: str, fetch: Callable[[str], Awaitable[str]] = dumb_parse) -> str:
+    """Окна вокруг ключевых слов и слов из вопроса, которые пойдут в суммаризацию"""
+    data = await bounds_based_parse(url, keywords=DEFAULT_KEYWORDS + question_terms(context),
+                                    limit=int(SUMMARY_INPUT_TOKENS * CONTEXT_CHARS_PER_TOKEN), fetch=fetch)
+    return truncate_tokens(data, SUMMARY_INPUT_TOKENS)
 
-async def summarize_text(url: str, sdk, context: str) -> str:
+
+async def summarize_windows(data: str, summarizer, context: str) -> str:
     """
-    Функция берет дамп текста со страницы и отправляет его в llm для
-    суммаризации / извлечения фактов
+    Отправляет окна текста страницы в llm для суммаризации / извлечения
+    фактов. Результат кэшируется по хэшу отправляемого текста и
+    нормализованному вопросу, поэтому изменение страницы само
+    инвалидирует старую суммаризацию
     """
-    data = await bounds_based_parse(url)
-    if not data:
-        return ""
+    key = summary_key(data, context)
+    cached = await summary_cache.get(key)
+    if cached is not None:
+        return cached
 
-    summarizer = sdk.models.completions('yandexgpt-lite').configure(temperature=0.3, max_tokens=4000)
     messages = [
         {
             "role": 'system',
@@ -88,18 +116,79 @@ async def summarize_text(url: str, sdk, context: str) -> str:
         },
         {
             "role": 'user',
-            "text": data[:min(8000, len(data))]
+            "text": data
         }
     ]
 
-    text = summarizer.run(messages)[0].text
+    with span('summarize'):
+        text = (await run_model(summarizer, messages, PRIORITY_SUMMARY))[0].text
+    if text:
+        await summary_cache.set(key, text)
     return text
 
 
-async def process_all_sources(sources: List[str], sdk: YCloudML, question_context: str) -> Dict[str, str]:
+def _succeeded(task: asyncio.Future) -> bool:
+    return task.done() and not task.cancelled() and task.exception() is None
+
+
+async def process_all_sources(sources: List[str], summarizer, question_context: str,
+                              fetch: Callable[[str], Awaitable[str]] = dumb_parse,
+                              wanted: int = 0,
+                              deadline: Optional[Deadline] = None,
+                              on_summary: Optional[Callable[[str, str], Awaitable[None]]] = None) -> Dict[str, str]:
     """
-    Асинхронная функция для асинхронного скрейпинга и суммаризации веб страниц
+    Асинхронная функция для асинхронного скрейпинга и суммаризации веб страниц.
+    Все кандидаты скачиваются сразу, суммаризация источника стартует, как только
+    в нем нашлись окна с ключевыми словами. Когда таких источников набралось
+    wanted, остальные скачивания отменяются, а суммаризации, не успевшие до
+    дедлайна (за вычетом резерва на финальный ответ), отбрасываются.
+    fetch позволяет подменить скачивание, например общим для пакета вопросов,
+    on_summary получает каждую готовую выжимку сразу, не дожидаясь остальных
     """
-    tasks = [summarize_text(url, sdk, question_context) for url in sources]
-    summarizations = await asyncio.gather(*tasks)
-    return {url: result for url, result in zip(sources, summarizations)}
+    wanted = wanted or len(sources)
+    if deadline is not None and deadline.budget(DEADLINE_FINAL_RESERVE) <= 0:
+        # остаток бюджета уже отдан финальному ответу, источники он получит пустыми
+        DEADLINE_EXCEEDED.inc(stage='sources')
+        SOURCES_DROPPED.inc(len(sources), reason='late')
+        return {}
+    fetches = {asyncio.ensure_future(source_windows(url, question_context, fetch)): url for url in sources}
+    summaries: Dict[asyncio.Future, str] = {}
+
+    def budget() -> Optional[float]:
+        return deadline.budget(DEADLINE_FINAL_RESERVE) if deadline is not None else None
+
+    async def summarize(url: str, data: str) -> str:
+        text = await summarize_windows(data, summarizer, question_context)
+        if text and on_summary is not None:
+            await on_summary(url, text)
+        return text
+
+    try:
+        pending = set(fetches)
+        while pending and len(summaries) < wanted:
+            done, pending = await asyncio.wait(pending, timeout=budget(), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                if not _succeeded(task) or not task.result():
+                    SOURCES_DROPPED.inc(reason='no_windows')
+                elif len(summaries) < wanted:
+                    summary = asyncio.ensure_future(summarize(fetches[task], task.result()))
+                    summaries[summary] = fetches[task]
+        SOURCES_DROPPED.inc(len(pending), reason='not_needed')
+
+        if summaries:
+            _, late = await asyncio.wait(summaries, timeout=budget())
+            SOURCES_DROPPED.inc(len(late), reason='late')
+    finally:
+        for task in list(fetches) + list(summaries):
+            task.cancel()
+
+    finished = [task for task in summaries if _succeeded(task)]
+    failed = [task for task in summaries if task.done() and not task.cancelled() and task.exception() is not None]
+    if failed and not finished:
+        raise failed[0].exception()
+    # порядок выдачи поиска сохраняется
+    rank = {url: position for position, url in enumerate(sources)}
+    return {url: task.result() for task, url in sorted(((task, summaries[task]) for task in finished),
+                                                       key=lambda item: rank[item[1]])}
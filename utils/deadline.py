@@ -0,0 +1,57 @@
+import asyncio
+import os
+import time
+from typing import Any, Awaitable
+
+from utils.exceptions import DeadlineExceeded
+from utils.metrics import DEADLINE_EXCEEDED
+
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', 60))
+# сколько секунд бюджета оставлять финальному вызову llm, пока идут поиск и источники
+DEADLINE_FINAL_RESERVE = float(os.getenv('DEADLINE_FINAL_RESERVE', 15))
+if REQUEST_DEADLINE <= DEADLINE_FINAL_RESERVE:
+    # иначе у поиска и источников никогда нет бюджета, и ответ всегда строится без фактов
+    raise ValueError(f'REQUEST_DEADLINE ({REQUEST_DEADLINE}) must be greater than '
+                     f'DEADLINE_FINAL_RESERVE ({DEADLINE_FINAL_RESERVE})')
+
+
+class Deadline:
+    """
+    Бюджет времени одного запроса, общий для всех стадий: каждая
+    стадия получает остаток, а не свой фиксированный таймаут, поэтому
+    медленный хост не может растянуть запрос дальше дедлайна
+    """
+
+    def __init__(self, seconds: float = REQUEST_DEADLINE):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def budget(self, reserve: float = 0.0) -> float:
+        """Сколько можно потратить сейчас, оставив reserve секунд следующим стадиям"""
+        return max(0.0, self.remaining() - reserve)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str) -> None:
+        if self.expired:
+            DEADLINE_EXCEEDED.inc(stage=stage)
+            raise DeadlineExceeded(f'Request deadline of {self.seconds} s exceeded before {stage}')
+
+    async def run(self, awaitable: Awaitable[Any], stage: str, reserve: float = 0.0) -> Any:
+        """Ждет awaitable не дольше бюджета, по истечении отменяет его"""
+        budget = self.budget(reserve)
+        if budget <= 0:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            DEADLINE_EXCEEDED.inc(stage=stage)
+            raise DeadlineExceeded(f'No time left in the request deadline for {stage}')
+        try:
+            return await asyncio.wait_for(awaitable, budget)
+        except asyncio.TimeoutError:
+            DEADLINE_EXCEEDED.inc(stage=stage)
+            raise DeadlineExceeded(f'{stage} did not finish within the request deadline of {self.seconds} s')
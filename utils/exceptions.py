@@ -2,3 +2,28 @@ class LLMWorkflowError(Exception):
     """Exception raised when the LLM workflow critically fails and needs to restart."""
     def __init__(self, message="LLM workflow encountered a critical failure and needs to restart"):
         super().__init__(message)
+
+
+class ThrottledError(Exception):
+    """Exception raised when an external API rejects a call because of rate limits."""
+    def __init__(self, message="External API is throttling requests"):
+        super().__init__(message)
+
+
+class DeadlineExceeded(LLMWorkflowError):
+    """Exception raised when a request runs out of its latency budget; retrying will not help."""
+    def __init__(self, message="Request deadline exceeded"):
+        super().__init__(message)
+
+
+class RateLimited(LLMWorkflowError):
+    """Exception raised when an external API keeps throttling after all retries; the client should retry later."""
+    def __init__(self, message="External API is still throttling requests, retry later", retry_after: float = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobQueueFull(Exception):
+    """Exception raised when the job queue of a worker is full and a new job is rejected."""
+    def __init__(self, message="Job queue is full, retry later"):
+        super().__init__(message)
@@ -0,0 +1,115 @@
+import asyncio
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from typing import Callable, Dict, Optional
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:  # lxml опционален, без него остаются bs4 и stream
+    lxml = None
+
+EXTRACT_BACKEND = os.getenv('EXTRACT_BACKEND', 'lxml' if lxml is not None else 'stream')
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 2))
+# страницы меньше этого размера разбираются прямо в event loop, пересылка в процесс дороже
+EXTRACT_INLINE_LIMIT = int(os.getenv('EXTRACT_INLINE_LIMIT', 32 * 1024))
+# fork из воркера, где уже работают потоки to_thread, может унаследовать захваченные ими блокировки
+EXTRACT_START_METHOD = os.getenv(
+    'EXTRACT_START_METHOD', 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+SKIP_TAGS = ('script', 'style', 'nav', 'noscript', 'template')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def extract_bs4(html: str) -> str:
+    """Исходный вариант: BeautifulSoup на html.parser"""
+    return BeautifulSoup(html, 'html.parser').get_text(' ', strip=True)
+
+
+def extract_lxml(html: str) -> str:
+    """Быстрый вариант на C парсере lxml, выкидывает служебные теги"""
+    try:
+        try:
+            tree = lxml.html.fromstring(html)
+        except ValueError:
+            # строки с xml декларацией кодировки lxml принимает только байтами
+            tree = lxml.html.fromstring(html.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+    except etree.ParserError:
+        return ''
+    etree.strip_elements(tree, etree.Comment, *SKIP_TAGS, with_tail=False)
+    return WHITESPACE_PATTERN.sub(' ', ' '.join(tree.itertext())).strip()
+
+
+class _TagStripper(HTMLParser):
+    """Потоково собирает текст, пропуская содержимое script/style/nav"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+
+def extract_stream(html: str) -> str:
+    """Потоковый вырезатель тегов на стандартной библиотеке"""
+    stripper = _TagStripper()
+    stripper.feed(html)
+    stripper.close()
+    return WHITESPACE_PATTERN.sub(' ', ' '.join(stripper.parts)).strip()
+
+
+BACKENDS: Dict[str, Callable[[str], str]] = {
+    'bs4': extract_bs4,
+    'stream': extract_stream,
+}
+if lxml is not None:
+    BACKENDS['lxml'] = extract_lxml
+
+
+def extract(html: str, backend: str = EXTRACT_BACKEND) -> str:
+    """Синхронно извлекает текст страницы в нижнем регистре"""
+    return BACKENDS.get(backend, extract_stream)(html).lower()
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS,
+                                    mp_context=multiprocessing.get_context(EXTRACT_START_METHOD))
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+
+
+async def extract_text(html: str, backend: str = EXTRACT_BACKEND) -> str:
+    """
+    Извлекает текст страницы, не блокируя event loop: большие страницы
+    разбираются в пуле из EXTRACT_WORKERS процессов
+    """
+    if len(html) < EXTRACT_INLINE_LIMIT or EXTRACT_WORKERS <= 0:
+        return extract(html, backend)
+    return await asyncio.get_running_loop().run_in_executor(get_pool(), extract, html, backend)
@@ -0,0 +1,73 @@
+import os
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from multidict import CIMultiDictProxy
+
+SCRAPE_CONNECT_TIMEOUT = float(os.getenv('SCRAPE_CONNECT_TIMEOUT', 3))
+SCRAPE_READ_TIMEOUT = float(os.getenv('SCRAPE_READ_TIMEOUT', 7))
+SCRAPE_TOTAL_TIMEOUT = float(os.getenv('SCRAPE_TOTAL_TIMEOUT', 15))
+SCRAPE_MAX_BYTES = int(os.getenv('SCRAPE_MAX_BYTES', 2 * 1024 * 1024))
+SCRAPE_POOL_LIMIT = int(os.getenv('SCRAPE_POOL_LIMIT', 100))
+SCRAPE_POOL_LIMIT_PER_HOST = int(os.getenv('SCRAPE_POOL_LIMIT_PER_HOST', 8))
+SCRAPE_KEEPALIVE = float(os.getenv('SCRAPE_KEEPALIVE', 30))
+SCRAPE_DNS_CACHE_TTL = int(os.getenv('SCRAPE_DNS_CACHE_TTL', 300))
+
+CHUNK_SIZE = 64 * 1024
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общий на весь воркер пул соединений для скрейпинга.
+    Создается лениво внутри работающего event loop
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=SCRAPE_POOL_LIMIT,
+            limit_per_host=SCRAPE_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=SCRAPE_KEEPALIVE,
+            ttl_dns_cache=SCRAPE_DNS_CACHE_TTL,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=SCRAPE_TOTAL_TIMEOUT,
+            sock_connect=SCRAPE_CONNECT_TIMEOUT,
+            sock_read=SCRAPE_READ_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def fetch_text(url: str,
+                     headers: Optional[Dict[str, str]] = None,
+                     max_bytes: int = SCRAPE_MAX_BYTES) -> Tuple[int, CIMultiDictProxy, str]:
+    """
+    Скачивает страницу потоково и обрезает тело на max_bytes, чтобы
+    огромные страницы не загружались целиком. Возвращает статус,
+    заголовки ответа и декодированный текст (пустой, если статус не 200)
+    """
+    async with get_session().get(url, headers=headers) as response:
+        if response.status != 200:
+            return response.status, response.headers, ''
+
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            body.extend(chunk)
+            if len(body) >= max_bytes:
+                del body[max_bytes:]
+                break
+
+        try:
+            text = body.decode(response.get_encoding(), errors='replace')
+        except (LookupError, RuntimeError):
+            text = body.decode('utf-8', errors='replace')
+        return response.status, response.headers, text
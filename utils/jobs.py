@@ -0,0 +1,285 @@
+import asyncio
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, List, Optional
+
+from pydantic import BaseModel
+
+from utils.cache import ProcessLocalConnection
+from utils.exceptions import JobQueueFull, LLMWorkflowError
+from utils.metrics import JOBS
+
+JOBS_PATH = os.getenv('JOBS_PATH', 'cache/jobs.sqlite')
+JOBS_CONCURRENCY = int(os.getenv('JOBS_CONCURRENCY', 4))
+JOBS_QUEUE_SIZE = int(os.getenv('JOBS_QUEUE_SIZE', 64))
+# задача не держит соединение клиента, поэтому ее бюджет времени больше, чем у /api/request
+JOBS_DEADLINE = float(os.getenv('JOBS_DEADLINE', 300))
+JOBS_TTL = float(os.getenv('JOBS_TTL', 24 * 3600))
+JOBS_MAX_WAIT = float(os.getenv('JOBS_MAX_WAIT', 30))
+JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', 0.25))
+# воркер раз в JOBS_HEARTBEAT секунд отмечает свои задачи живыми; задачи без отметки
+# дольше трех интервалов считаются брошенными (воркер или контейнер умер)
+JOBS_HEARTBEAT = float(os.getenv('JOBS_HEARTBEAT', 10))
+JOBS_STALE_AFTER = 3 * JOBS_HEARTBEAT
+JOBS_RETRY_AFTER = 5
+
+FINISHED = ('done', 'failed')
+
+
+class Job(BaseModel):
+    id: str
+    status: str
+    priority: int
+    query_id: int
+    query: str
+    stages: List[str] = []
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: float
+    updated_at: float
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED
+
+
+class JobStore:
+    """
+    Состояние задач в sqlite файле, общем для всех воркеров: задачу
+    выполняет принявший ее воркер, а прогресс и результат может
+    отдать любой. Завершенные задачи удаляются через ttl
+    """
+
+    def __init__(self, path: str = JOBS_PATH, ttl: float = JOBS_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = ProcessLocalConnection(path or ':memory:', self._create_table)
+        self._owner: Optional[str] = None
+        self._owner_pid: Optional[int] = None
+
+    @staticmethod
+    def _create_table(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL, query_id INTEGER NOT NULL, '
+            'query TEXT NOT NULL, stages TEXT NOT NULL, result TEXT, error TEXT, owner TEXT NOT NULL, '
+            'heartbeat REAL NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated_at)')
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    @property
+    def owner(self) -> str:
+        """
+        Уникальный id процесса-владельца задач. Pid для этого не годится:
+        после рестарта контейнера новый воркер может получить pid умершего
+        """
+        if self._owner_pid != os.getpid():
+            self._owner, self._owner_pid = f'{os.getpid()}-{uuid.uuid4().hex}', os.getpid()
+        return self._owner
+
+    def _create(self, job: Job) -> None:
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO jobs (id, status, priority, query_id, query, stages, result, error, owner, '
+                'heartbeat, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?, ?, ?, ?)',
+                (job.id, job.status, job.priority, job.query_id, job.query, json.dumps(job.stages),
+                 self.owner, time.time(), job.created_at, job.updated_at),
+            )
+            self._conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                               (time.time() - self.ttl,))
+
+    def _get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, status, priority, query_id, query, stages, result, error, created_at, updated_at '
+                'FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Job(id=row[0], status=row[1], priority=row[2], query_id=row[3], query=row[4],
+                   stages=json.loads(row[5]), result=json.loads(row[6]) if row[6] else None,
+                   error=row[7], created_at=row[8], updated_at=row[9])
+
+    def _update(self, job_id: str, status: Optional[str] = None, stage: Optional[str] = None,
+                result: Optional[dict] = None, error: Optional[str] = None) -> None:
+        with self._lock:
+            row = self._conn.execute('SELECT status, stages FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return
+            stages = json.loads(row[1])
+            if stage is not None:
+                stages.append(stage)
+            self._conn.execute(
+                'UPDATE jobs SET status = ?, stages = ?, result = COALESCE(?, result), error = COALESCE(?, error), '
+                'updated_at = ? WHERE id = ?',
+                (status or row[0], json.dumps(stages), json.dumps(result) if result is not None else None,
+                 error, time.time(), job_id),
+            )
+
+    def _heartbeat(self) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                (time.time(), self.owner))
+
+    def _abandon_orphans(self, stale_after: float = JOBS_STALE_AFTER) -> int:
+        """
+        Задачи, чей воркер давно не отмечался, уже никто не выполнит -
+        помечаем их упавшими. Свои задачи процесс не трогает
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Worker stopped before the job finished', "
+                "updated_at = ? WHERE status IN ('queued', 'running') AND owner != ? AND heartbeat < ?",
+                (now, self.owner, now - stale_after))
+        return cursor.rowcount
+
+    async def create(self, job: Job) -> None:
+        await asyncio.to_thread(self._create, job)
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await asyncio.to_thread(self._get, job_id)
+
+    async def update(self, job_id: str, **fields) -> None:
+        await asyncio.to_thread(self._update, job_id, **fields)
+
+    async def heartbeat(self) -> None:
+        await asyncio.to_thread(self._heartbeat)
+
+    async def abandon_orphans(self) -> int:
+        return await asyncio.to_thread(self._abandon_orphans)
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        """
+        Long-poll: ждет, пока задача изменится (новая стадия, статус)
+        или завершится, но не дольше timeout. Опрашивает файл, поэтому
+        работает для задач любого воркера
+        """
+        job = await self.get(job_id)
+        if job is None or job.finished or timeout <= 0:
+            return job
+        since = job.updated_at
+        expires_at = time.monotonic() + timeout
+        while time.monotonic() < expires_at:
+            await asyncio.sleep(min(JOBS_POLL_INTERVAL, max(0.0, expires_at - time.monotonic())))
+            job = await self.get(job_id)
+            if job is None or job.finished or job.updated_at > since:
+                break
+        return job
+
+
+JobHandler = Callable[[Job, Callable[[str], Awaitable[None]]], Awaitable[dict]]
+
+
+class JobQueue:
+    """
+    Очередь задач воркера с приоритетами (меньше - раньше) и ограниченным
+    числом одновременно решаемых вопросов. Когда очередь заполнена, новая
+    задача сразу отклоняется, а не копится: при всплеске клиент получает
+    503 с Retry-After, а время ответа принятых задач остается стабильным
+    """
+
+    def __init__(self, store: JobStore, handler: JobHandler,
+                 concurrency: int = JOBS_CONCURRENCY, maxsize: int = JOBS_QUEUE_SIZE):
+        self.store = store
+        self.handler = handler
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.running = 0
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+        self._counter = itertools.count()
+        # места в очереди, занятые задачами, которые еще записываются в store
+        self._reserved = 0
+
+    def start(self) -> None:
+        """Очередь создается внутри event loop воркера"""
+        self._queue = asyncio.PriorityQueue(maxsize=self.maxsize)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+        self._workers.append(asyncio.create_task(self._heartbeat()))
+
+    async def _heartbeat(self) -> None:
+        """Отмечает задачи воркера живыми и заодно подбирает брошенные задачи умерших воркеров"""
+        while True:
+            try:
+                await self.store.heartbeat()
+                await self.store.abandon_orphans()
+            except sqlite3.Error:
+                pass
+            await asyncio.sleep(JOBS_HEARTBEAT)
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while self._queue is not None and not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            await self.store.update(job.id, status='failed', error='Worker stopped before the job started')
+
+    async def submit(self, query_id: int, query: str, priority: int = 1) -> Job:
+        # место резервируется до записи в store: иначе параллельные submit,
+        # прошедшие проверку, переполнят очередь, пока идет запись
+        if self._queue is None or self._queue.qsize() + self._reserved >= self.maxsize:
+            JOBS.inc(result='rejected')
+            raise JobQueueFull(f'Job queue is full ({self.maxsize} jobs), retry later')
+        self._reserved += 1
+        try:
+            now = time.time()
+            job = Job(id=uuid.uuid4().hex, status='queued', priority=priority, query_id=query_id, query=query,
+                      created_at=now, updated_at=now)
+            await self.store.create(job)
+        finally:
+            self._reserved -= 1
+        self._queue.put_nowait((priority, next(self._counter), job))
+        JOBS.inc(result='accepted')
+        return job
+
+    async def _work(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            self.running += 1
+            try:
+                await self._run(job)
+            finally:
+                self.running -= 1
+                self._queue.task_done()
+
+    async def _run(self, job: Job) -> None:
+        await self.store.update(job.id, status='running')
+
+        async def progress(stage: str) -> None:
+            await self.store.update(job.id, stage=stage)
+
+        try:
+            result = await self.handler(job, progress)
+        except asyncio.CancelledError:
+            await self.store.update(job.id, status='failed', error='Worker stopped before the job finished')
+            raise
+        except LLMWorkflowError as e:
+            JOBS.inc(result='failed')
+            await self.store.update(job.id, status='failed', error=str(e))
+        except Exception:
+            JOBS.inc(result='failed')
+            await self.store.update(job.id, status='failed', error='Internal server error')
+        else:
+            JOBS.inc(result='done')
+            await self.store.update(job.id, status='done', result=result)
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'running': self.running,
+            'capacity': self.maxsize,
+            'concurrency': self.concurrency,
+        }
@@ -0,0 +1,234 @@
+import json
+import re
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+FENCE_PATTERN = re.compile(r'```(?:json)?\s*(.*?)(?:```|$)', re.S | re.I)
+LEADING_NUMBER_PATTERN = re.compile(r'^\s*(-?\d+)')
+DECIMAL_PATTERN = re.compile(r'^\s*(-?\d+(?:[.,]\d+)?)')
+PYTHON_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+# ожидаемые формы ответов llm: поле -> тип
+QUERY_SCHEMA = {'query': str}
+FINAL_SCHEMA = {'answer': int, 'reasoning': str, 'sources': list}
+DIRECT_SCHEMA = {'answer': int, 'confidence': float, 'reasoning': str, 'sources': list}
+
+
+def json_objects(text: str) -> List[str]:
+    """
+    Внешние {...} в тексте с учетом строк. Незакрытый в конце объект
+    (ответ обрезан по max_tokens) тоже попадает в список
+    """
+    spans, depth, start, in_string, escaped = [], 0, -1, False, False
+    for position, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"' and depth:
+            in_string = True
+        elif char == '{':
+            if depth == 0:
+                start = position
+            depth += 1
+        elif char == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                spans.append(text[start:position + 1])
+    if depth:
+        spans.append(text[start:])
+    return spans
+
+
+def candidates(text: str) -> Iterator[str]:
+    """
+    Места, где может лежать json, от самых вероятных: блоки кода,
+    часть после `---`, затем объекты в тексте с конца (llm обычно
+    пишет итоговый json последним)
+    """
+    seen = set()
+    sources = [match.group(1) for match in FENCE_PATTERN.finditer(text)][::-1]
+    if '---' in text:
+        sources.append(text.rsplit('---', 1)[1])
+    sources.append(text)
+    for source in sources:
+        for candidate in json_objects(source)[::-1]:
+            if candidate not in seen:
+                seen.add(candidate)
+                yield candidate
+
+
+def _closes_string(text: str, position: int) -> bool:
+    """Кавычка закрывает строку, только если за ней идет конец значения или ключа"""
+    rest = text[position + 1:].lstrip()
+    return not rest or rest[0] in ',:}]'
+
+
+def repair(text: str) -> Tuple[str, List[Tuple[int, List[str]]]]:
+    """
+    Один проход по тексту: одинарные кавычки -> двойные, переводы строк
+    и лишние кавычки внутри строк экранируются, висящие запятые и
+    литералы python исправляются. Возвращает текст и позиции запятых,
+    по которым можно откатиться у обрезанного ответа
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    commas: List[Tuple[int, List[str]]] = []
+    quote = ''
+    position = 0
+    while position < len(text):
+        char = text[position]
+        if quote:
+            if char == '\\' and position + 1 < len(text):
+                out.append(text[position:position + 2])
+                position += 2
+                continue
+            if char == quote and _closes_string(text, position):
+                out.append('"')
+                quote = ''
+            elif char == '"':
+                out.append('\\"')
+            elif char == '\n':
+                out.append('\\n')
+            elif char == '\r':
+                out.append('\\r')
+            elif char == '\t':
+                out.append('\\t')
+            else:
+                out.append(char)
+        elif char in '"\'':
+            quote = char
+            out.append('"')
+        elif char in '{[':
+            stack.append(char)
+            out.append(char)
+        elif char in '}]':
+            while out and (out[-1].isspace() or out[-1] == ','):
+                out.pop()
+            while commas and commas[-1][0] >= len(out):
+                commas.pop()
+            if stack:
+                stack.pop()
+            out.append(char)
+        elif char == ',':
+            commas.append((len(out), list(stack)))
+            out.append(char)
+        elif char.isalpha():
+            word = re.match(r'[A-Za-z]+', text[position:])
+            if word and word.group(0) in PYTHON_LITERALS:
+                out.append(PYTHON_LITERALS[word.group(0)])
+                position += len(word.group(0))
+                continue
+            out.append(char)
+        else:
+            out.append(char)
+        position += 1
+
+    # номера токенов запятых -> позиции в итоговом тексте
+    cuts, offset, token = [], 0, 0
+    for index, stack_at_comma in commas:
+        while token < index:
+            offset += len(out[token])
+            token += 1
+        cuts.append((offset, stack_at_comma))
+
+    repaired = ''.join(out)
+    if quote:
+        repaired += '"'
+    return close(repaired, stack), cuts
+
+
+def close(text: str, stack: Sequence[str]) -> str:
+    """Дописывает закрывающие скобки обрезанному json"""
+    text = text.rstrip()
+    if text.endswith(','):
+        text = text[:-1]
+    elif text.endswith(':'):
+        text += ' null'
+    return text + ''.join('}' if bracket == '{' else ']' for bracket in reversed(stack))
+
+
+def loads(text: str) -> Tuple[Any, bool]:
+    """
+    json.loads, а если не вышло - после ремонта. Возвращает объект и
+    признак того, что понадобился ремонт. ValueError, если не помогло
+    """
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError:
+        pass
+    repaired, commas = repair(text)
+    try:
+        return json.loads(repaired), True
+    except json.JSONDecodeError:
+        pass
+    # обрезанный ответ: отбрасываем недописанный хвост до последней целой пары
+    for position, stack in reversed(commas):
+        try:
+            return json.loads(close(repaired[:position], stack)), True
+        except json.JSONDecodeError:
+            continue
+    raise ValueError('Text does not contain recoverable json')
+
+
+def conform(value: Any, schema: Dict[str, type], required: Sequence[str]) -> Optional[Dict[str, Any]]:
+    """
+    Приводит объект к схеме: номер ответа к int (-1, если это не число),
+    уверенность к float (0, если это не число), строку источников к
+    списку. None, если нет обязательных полей
+    или обязательная строка пустая
+    """
+    if not isinstance(value, dict):
+        return None
+    for key in required:
+        if key not in value or (schema.get(key) is str and not str(value[key] or '').strip()):
+            return None
+    result = {}
+    for key, kind in schema.items():
+        item = value.get(key)
+        if kind is int:
+            if isinstance(item, bool) or not isinstance(item, (int, float, str)):
+                item = -1
+            elif isinstance(item, str):
+                match = LEADING_NUMBER_PATTERN.match(item)
+                item = int(match.group(1)) if match else -1
+            else:
+                item = int(item)
+        elif kind is float:
+            if isinstance(item, bool) or not isinstance(item, (int, float, str)):
+                item = 0.0
+            elif isinstance(item, str):
+                match = DECIMAL_PATTERN.match(item)
+                item = float(match.group(1).replace(',', '.')) if match else 0.0
+            else:
+                item = float(item)
+        elif kind is list:
+            if item is None:
+                item = []
+            elif not isinstance(item, list):
+                item = [item]
+            item = [str(element) for element in item if element]
+        else:
+            item = '' if item is None else str(item)
+        result[key] = item
+    return result
+
+
+def extract_json(text: str, schema: Dict[str, type],
+                 required: Sequence[str] = ()) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    Ищет в ответе llm объект нужной схемы. Возвращает его и путь, которым
+    он найден: strict (валидный json), repaired (после ремонта) или failed
+    """
+    required = required or tuple(schema)[:1]
+    for candidate in candidates(text):
+        try:
+            value, repaired = loads(candidate)
+        except ValueError:
+            continue
+        conformed = conform(value, schema, required)
+        if conformed is not None:
+            return conformed, 'repaired' if repaired else 'strict'
+    return None, 'failed'
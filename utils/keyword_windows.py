@@ -0,0 +1,109 @@
+import os
+import re
+from functools import lru_cache
+from typing import Iterable, List, NamedTuple, Pattern, Tuple
+
+from utils.questions import split_options
+from utils.terms import stem, STOP_WORDS
+
+DEFAULT_KEYWORDS = tuple(
+    keyword.strip().lower()
+    for keyword in os.getenv('WINDOW_KEYWORDS', 'университет итмо,itmo university,итмо,itmo').split(',')
+    if keyword.strip()
+)
+
+TERM_PATTERN = re.compile(r'[\w-]{5,}')
+
+
+class Window(NamedTuple):
+    start: int
+    end: int
+    hits: int
+
+    @property
+    def density(self) -> float:
+        return self.hits / max(1, self.end - self.start)
+
+
+@lru_cache(maxsize=256)
+def compile_keywords(keywords: Tuple[str, ...]) -> Pattern:
+    """
+    Один regex на весь набор ключевых слов: более длинные идут первыми,
+    чтобы "университет итмо" выигрывал у "итмо"
+    """
+    ordered = sorted(set(keywords), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(keyword) for keyword in ordered))
+
+
+def question_terms(question: str, limit: int = 12) -> Tuple[str, ...]:
+    """
+    Ключевые слова из вопроса и вариантов ответа с отрезанными
+    окончаниями (utils.terms.stem)
+    """
+    wording, options = split_options(question)
+    terms = []
+    for word in TERM_PATTERN.findall(' '.join([wording] + [text for _, text in options])):
+        if word in STOP_WORDS:
+            continue
+        term = stem(word)
+        if term not in terms:
+            terms.append(term)
+    return tuple(terms[:limit])
+
+
+def find_windows(source: str, keywords: Iterable[str] = DEFAULT_KEYWORDS, bound: int = 100) -> List[Window]:
+    """
+    Один проход по тексту: совпадения всех ключевых слов сразу
+    превращаются в окна ±bound, пересекающиеся окна сливаются
+    как интервалы за линейное время
+    """
+    pattern = compile_keywords(tuple(keywords))
+    windows: List[Window] = []
+    window_start, window_end, hits = 0, -1, 0
+    for match in pattern.finditer(source):
+        match_start, match_end = match.span()
+        # совпадения идут слева направо и не пересекаются, поэтому концы окон монотонны
+        if match_start - bound <= window_end:
+            window_end = match_end + bound
+            hits += 1
+            continue
+        if hits:
+            windows.append(Window(window_start, min(window_end, len(source)), hits))
+        window_start, window_end, hits = max(0, match_start - bound), match_end + bound, 1
+    if hits:
+        windows.append(Window(window_start, min(window_end, len(source)), hits))
+    return windows
+
+
+def rank_windows(windows: List[Window]) -> List[Window]:
+    """Сортирует окна по плотности ключевых слов"""
+    return sorted(windows, key=lambda window: (window.density, window.hits), reverse=True)
+
+
+def select_windows(windows: List[Window], limit: int) -> List[Window]:
+    """
+    Оставляет самые плотные окна, которые помещаются в limit символов,
+    и возвращает их в порядке следования в документе
+    """
+    selected, size = [], 0
+    for window in rank_windows(windows):
+        remaining = limit - size
+        if remaining <= 0:
+            break
+        if window.end - window.start > remaining:
+            # последнее окно обрезается по оставшемуся месту
+            window = Window(window.start, window.start + remaining, window.hits)
+        selected.append(window)
+        size += window.end - window.start
+    return sorted(selected)
+
+
+def extract_windows(source: str,
+                    keywords: Iterable[str] = DEFAULT_KEYWORDS,
+                    bound: int = 100,
+                    limit: int = 0) -> str:
+    """Извлекает текст вокруг ключевых слов, при limit > 0 только самые плотные окна"""
+    windows = find_windows(source, keywords, bound)
+    if limit and sum(window.end - window.start for window in windows) > limit:
+        windows = select_windows(windows, limit)
+    return '\n'.join(source[window.start:window.end] for window in windows)
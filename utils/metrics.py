@@ -0,0 +1,174 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(str(labels.get(name, '')) for name in self.labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        # [счетчики по бакетам..., +Inf, sum]
+        state = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[index] += 1
+        state[len(self.buckets)] += 1
+        state[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, state in sorted(self._values.items()):
+            for index, bound in enumerate(self.buckets):
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, ("le", str(bound)))} {state[index]}')
+            count = state[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, ("le", "+Inf"))} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {round(state[-1], 6)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+
+class Registry:
+    """
+    Минимальный реестр метрик в текстовом формате Prometheus. Значения
+    живут в памяти воркера, collectors позволяют отдать состояние
+    других модулей (кэши, лимитеры) в момент скрейпа
+    """
+
+    def __init__(self):
+        self._metrics: list = []
+        self._collectors: List[Callable[[], List[str]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], List[str]]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+def gauge_lines(name: str, documentation: str, values: Dict[LabelValues, float], labels: Sequence[str] = ()):
+    """Рендерит набор значений как gauge, удобно для collectors"""
+    lines = [f'# HELP {name} {documentation}', f'# TYPE {name} gauge']
+    for key, value in sorted(values.items()):
+        lines.append(f'{name}{_format_labels(labels, key)} {value}')
+    return lines
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'pipeline_stage_seconds', 'Latency of answer pipeline stages', ['stage']))
+RETRIED_STAGES = REGISTRY.register(Counter(
+    'pipeline_stage_retries_total', 'Failed attempts of answer pipeline stages that were retried', ['stage']))
+CLEANUP_FALLBACKS = REGISTRY.register(Counter(
+    'pipeline_cleanup_fallback_total', 'Calls to the cleanup LLM when the response could not be parsed', ['kind']))
+JSON_RECOVERY = REGISTRY.register(Counter(
+    'pipeline_json_recovery_total', 'How structured LLM output was recovered (strict, repaired, cleanup_llm, failed)',
+    ['kind', 'path']))
+CONTEXT_TOKENS = REGISTRY.register(Histogram(
+    'pipeline_context_tokens', 'Estimated tokens of facts packed into the final prompt',
+    buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000)))
+SCRAPES = REGISTRY.register(Counter(
+    'scrape_total', 'Scraped pages by result (ok, cached, not_modified, stale, gone, empty, error)', ['result']))
+DEADLINE_EXCEEDED = REGISTRY.register(Counter(
+    'deadline_exceeded_total', 'Requests that ran out of their latency budget, by stage', ['stage']))
+SOURCES_DROPPED = REGISTRY.register(Counter(
+    'sources_dropped_total', 'Candidate sources not used (duplicate, not_html, no_windows, not_needed, late)',
+    ['reason']))
+LOCAL_RETRIEVAL = REGISTRY.register(Counter(
+    'local_retrieval_total', 'Local index lookups by result (hit, fallback, no_index)', ['result']))
+CASCADE_ANSWERS = REGISTRY.register(Counter(
+    'pipeline_cascade_answers_total', 'Answers by the cascade tier that produced them (direct, local, retrieval, strong)',
+    ['tier']))
+DIRECT_ANSWERS = REGISTRY.register(Counter(
+    'pipeline_direct_answers_total', 'Direct answers without retrieval by result (accepted, low_confidence, failed)',
+    ['result']))
+DIRECT_CONFIDENCE = REGISTRY.register(Histogram(
+    'pipeline_direct_confidence', 'Self-reported confidence of direct answers',
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)))
+JOBS = REGISTRY.register(Counter(
+    'jobs_total', 'Background jobs by outcome (accepted, rejected, done, failed)', ['result']))
+BATCH_DEDUPLICATED = REGISTRY.register(Counter(
+    'batch_deduplicated_total', 'Search and fetch calls shared with another question of the same batch', ['kind']))
+
+_timings: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar('timings', default=None)
+
+
+def start_timings() -> Dict[str, List[float]]:
+    """Начинает сбор разбивки по стадиям для текущего запроса"""
+    timings: Dict[str, List[float]] = {}
+    _timings.set(timings)
+    return timings
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Замеряет стадию: пишет длительность в гистограмму и в разбивку
+    текущего запроса, если она собирается
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(duration, stage=stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings.setdefault(stage, []).append(round(duration * 1000, 1))
+
+
+def server_timing(timings: Dict[str, List[float]]) -> str:
+    """Заголовок Server-Timing: для повторяющихся стадий берется самая долгая"""
+    return ', '.join(f'{stage};dur={max(durations)}' for stage, durations in timings.items())
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+from utils.cache import ProcessLocalConnection
+
+PAGE_CACHE_PATH = os.getenv('PAGE_CACHE_PATH', 'cache/pages.sqlite')
+PAGE_CACHE_FRESHNESS = float(os.getenv('PAGE_CACHE_FRESHNESS', 6 * 3600))
+PAGE_CACHE_MAX_BYTES = int(os.getenv('PAGE_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+
+
+class CachedPage(BaseModel):
+    url: str
+    text: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    fetched_at: float
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() - self.fetched_at < PAGE_CACHE_FRESHNESS
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """Заголовки условного GET для ревалидации страницы"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class PageCache:
+    """
+    Персистентный кэш страниц по url: хранит уже извлеченный текст
+    и метаданные ответа (ETag / Last-Modified) для условных запросов.
+    При превышении max_bytes вытесняет давно не читанные страницы
+    """
+
+    def __init__(self, path: str, max_bytes: int = PAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = ProcessLocalConnection(path, self._create_table)
+
+    @staticmethod
+    def _create_table(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'url TEXT PRIMARY KEY, text TEXT NOT NULL, etag TEXT, last_modified TEXT, '
+            'fetched_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed_at)')
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    def _get(self, url: str) -> Optional[CachedPage]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT text, etag, last_modified, fetched_at FROM pages WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE pages SET accessed_at = ? WHERE url = ?', (time.time(), url))
+        return CachedPage(url=url, text=row[0], etag=row[1], last_modified=row[2], fetched_at=row[3])
+
+    def _put(self, url: str, text: str, etag: Optional[str], last_modified: Optional[str]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO pages (url, text, etag, last_modified, fetched_at, accessed_at, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, text, etag, last_modified, now, now, len(text.encode('utf-8'))),
+            )
+            self._evict()
+
+    def _touch(self, url: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?', (now, now, url))
+
+    def _delete(self, url: str) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+
+    def _evict(self) -> None:
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        freed = 0
+        victims = []
+        for url, size in self._conn.execute('SELECT url, size FROM pages ORDER BY accessed_at'):
+            victims.append((url,))
+            freed += size
+            if total - freed <= self.max_bytes:
+                break
+        self._conn.executemany('DELETE FROM pages WHERE url = ?', victims)
+
+    async def get(self, url: str) -> Optional[CachedPage]:
+        return await asyncio.to_thread(self._get, url)
+
+    async def put(self, url: str, text: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        await asyncio.to_thread(self._put, url, text, etag, last_modified)
+
+    async def touch(self, url: str) -> None:
+        """Отмечает страницу свежей после ответа 304 Not Modified"""
+        await asyncio.to_thread(self._touch, url)
+
+    async def delete(self, url: str) -> None:
+        """Удаляет страницу, которой больше нет (404, 410)"""
+        await asyncio.to_thread(self._delete, url)
+
+
+page_cache: Optional[PageCache] = PageCache(PAGE_CACHE_PATH) if PAGE_CACHE_PATH else None
+
+
+async def warmup(urls: List[str], concurrency: int = 8) -> int:
+    """
+    Прогревает кэш страниц списком url, возвращает количество
+    страниц, из которых удалось извлечь текст
+    """
+    from utils.data_retrival_util import dumb_parse
+    from utils.http_client import close_session
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def load(url: str) -> bool:
+        async with semaphore:
+            return bool(await dumb_parse(url))
+
+    try:
+        results = await asyncio.gather(*[load(url) for url in urls])
+    finally:
+        await close_session()
+    return sum(results)
+
+
+if __name__ == '__main__':
+    # python -m utils.page_cache urls.txt
+    if len(sys.argv) != 2 or page_cache is None:
+        print('usage: PAGE_CACHE_PATH=... python -m utils.page_cache <file with urls>')
+        sys.exit(1)
+    with open(sys.argv[1]) as url_file:
+        url_list = [line.strip() for line in url_file if line.strip() and not line.startswith('#')]
+    loaded = asyncio.run(warmup(url_list))
+    print(f'warmed up {loaded}/{len(url_list)} pages')
@@ -0,0 +1,68 @@
+import hashlib
+import re
+from typing import List, Tuple, Dict, Any
+
+from schemas.request import PredictionResponse
+
+OPTION_PATTERN = re.compile(r'^\s*(\d+)\s*[.)]\s*(.*)$')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к нижнему регистру и схлопывает пробелы"""
+    return WHITESPACE_PATTERN.sub(' ', text).strip().lower()
+
+
+def split_options(question: str) -> Tuple[str, List[Tuple[int, str]]]:
+    """
+    Разделяет вопрос на формулировку и варианты ответа вида `1. Москва`.
+    Возвращает нормализованную формулировку и список (номер, текст варианта)
+    """
+    stem_lines, options = [], []
+    for line in question.splitlines():
+        match = OPTION_PATTERN.match(line)
+        if match and match.group(2).strip():
+            options.append((int(match.group(1)), normalize_text(match.group(2))))
+        else:
+            stem_lines.append(line)
+    return normalize_text(' '.join(stem_lines)), options
+
+
+def question_key(question: str) -> str:
+    """
+    Ключ вопроса, не зависящий от пробелов, регистра и порядка
+    вариантов ответа
+    """
+    stem, options = split_options(question)
+    canonical = '\n'.join([stem] + sorted(text for _, text in options))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def to_entry(question: str, response: PredictionResponse) -> Dict[str, Any]:
+    """
+    Превращает ответ в запись кэша. Номер варианта хранится как его текст,
+    чтобы ответ можно было восстановить при другом порядке вариантов
+    """
+    _, options = split_options(question)
+    answer_text = dict(options).get(response.answer)
+    return {
+        'answer': response.answer,
+        'answer_text': answer_text,
+        'reasoning': response.reasoning,
+        'sources': response.sources,
+    }
+
+
+def from_entry(question: str, entry: Dict[str, Any], query_id: int) -> PredictionResponse:
+    """Восстанавливает ответ из записи кэша для конкретного запроса"""
+    answer = entry['answer']
+    if entry.get('answer_text') is not None:
+        _, options = split_options(question)
+        answer = next((number for number, text in options if text == entry['answer_text']), answer)
+
+    return PredictionResponse(
+        id=query_id,
+        answer=answer,
+        reasoning=entry['reasoning'],
+        sources=entry['sources'],
+    )
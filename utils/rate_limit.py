@@ -0,0 +1,211 @@
+import asyncio
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import grpc
+
+from utils.exceptions import RateLimited, ThrottledError
+
+# чем меньше число, тем раньше вызов выйдет из очереди
+PRIORITY_FINAL = 0
+PRIORITY_QUERY = 1
+PRIORITY_SUMMARY = 2
+
+RATE_LIMIT_DIR = os.getenv('RATE_LIMIT_DIR', 'cache/rate_limits')
+RATE_LIMIT_RETRIES = int(os.getenv('RATE_LIMIT_RETRIES', 4))
+RATE_LIMIT_BACKOFF = float(os.getenv('RATE_LIMIT_BACKOFF', 0.5))
+# через сколько секунд клиенту предлагается повторить запрос, если api так и не пропустил вызов
+RATE_LIMIT_RETRY_AFTER = int(os.getenv('RATE_LIMIT_RETRY_AFTER', 5))
+
+# запросов в секунду на весь инстанс (все воркеры вместе) и стартовое окно конкурентности на воркер
+LIMITS = {
+    'yandexgpt-lite': {'rps': float(os.getenv('LLM_LITE_RPS', 10)), 'window': int(os.getenv('LLM_LITE_WINDOW', 8))},
+    'yandexgpt': {'rps': float(os.getenv('LLM_PRO_RPS', 5)), 'window': int(os.getenv('LLM_PRO_WINDOW', 4))},
+    'search': {'rps': float(os.getenv('SEARCH_RPS', 5)), 'window': int(os.getenv('SEARCH_WINDOW', 4))},
+}
+DEFAULT_LIMIT = {'rps': 5.0, 'window': 4}
+
+
+def is_throttling(error: BaseException) -> bool:
+    """Ошибка означает, что нас ограничивает api, и запрос стоит повторить позже"""
+    if isinstance(error, ThrottledError):
+        return True
+    if isinstance(error, grpc.RpcError) and hasattr(error, 'code'):
+        return error.code() == grpc.StatusCode.RESOURCE_EXHAUSTED
+    return False
+
+
+class TokenBucket:
+    """
+    Token bucket, общий для всех воркеров gunicorn: состояние лежит
+    в маленьком файле под fcntl блокировкой. Без пути работает в памяти
+    """
+
+    def __init__(self, name: str, rate: float, capacity: Optional[float] = None, directory: str = RATE_LIMIT_DIR):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self.path = os.path.join(directory, f'{name}.bucket') if directory else None
+        if self.path:
+            os.makedirs(directory, exist_ok=True)
+
+    def _take(self, tokens: float, updated: float):
+        """Пополняет ведро и пытается взять токен. Возвращает новое состояние и сколько ждать"""
+        now = time.time()
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0.0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def _try_acquire(self) -> float:
+        if self.path is None:
+            self._tokens, self._updated, wait = self._take(self._tokens, self._updated)
+            return wait
+
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                raw = state_file.read()
+                state = json.loads(raw) if raw else {'tokens': self.capacity, 'updated': time.time()}
+                tokens, updated, wait = self._take(state['tokens'], state['updated'])
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps({'tokens': tokens, 'updated': updated}))
+                state_file.flush()
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+        return wait
+
+    async def acquire(self) -> None:
+        while True:
+            wait = await asyncio.to_thread(self._try_acquire)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """
+    Ограничитель одного api: token bucket на частоту запросов плюс
+    AIMD окно конкурентности внутри воркера. Окно растет на 1/window
+    после каждого успеха и делится пополам при троттлинге. Ожидающие
+    вызовы выходят из очереди по приоритету
+    """
+
+    def __init__(self, name: str, rps: float, window: int, min_window: int = 1, max_window: int = 64):
+        self.name = name
+        self.bucket = TokenBucket(name, rps)
+        self.window = float(window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.in_flight = 0
+        self.throttled = 0
+        self._queue: List[tuple] = []
+        self._counter = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    async def _enter(self, priority: int) -> None:
+        if self.in_flight < int(self.window) and not self._queue:
+            self.in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._counter), waiter))
+        self._wake()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # слот уже выдан, но вызов отменили, отдаем его следующему
+                self._leave()
+            raise
+
+    def _leave(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._queue and self.in_flight < int(self.window):
+            _, _, waiter = heapq.heappop(self._queue)
+            if waiter.cancelled():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _on_success(self) -> None:
+        self.window = min(self.max_window, self.window + 1 / self.window)
+        self._wake()
+
+    def _on_throttle(self) -> None:
+        self.throttled += 1
+        self.window = max(self.min_window, self.window / 2)
+
+    async def call(self, factory: Callable[[], Awaitable[Any]], priority: int = PRIORITY_SUMMARY) -> Any:
+        """
+        Выполняет вызов api, когда освободится место в окне и появится токен.
+        При троттлинге повторяет запрос с экспоненциальной задержкой, а когда
+        ретраи кончились, бросает RateLimited: клиент получит 503 с Retry-After
+        """
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            await self._enter(priority)
+            try:
+                await self.bucket.acquire()
+                result = await factory()
+            except Exception as e:
+                if not is_throttling(e):
+                    raise
+                self._on_throttle()
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise RateLimited(f'{self.name} API is still throttling after {RATE_LIMIT_RETRIES} retries, '
+                                      f'retry later', RATE_LIMIT_RETRY_AFTER) from e
+            else:
+                self._on_success()
+                return result
+            finally:
+                self._leave()
+
+            await asyncio.sleep(RATE_LIMIT_BACKOFF * 2 ** attempt * (1 + random.random()))
+
+    def stats(self) -> dict:
+        return {
+            'window': round(self.window, 2),
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'throttled': self.throttled,
+        }
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+
+
+def get_limiter(name: str) -> AdaptiveLimiter:
+    if name not in _limiters:
+        limit = LIMITS.get(name, DEFAULT_LIMIT)
+        _limiters[name] = AdaptiveLimiter(name, rps=limit['rps'], window=limit['window'])
+    return _limiters[name]
+
+
+def model_name(model: Any) -> str:
+    """Достает имя модели из uri вида gpt://<folder>/yandexgpt-lite/latest"""
+    parts = str(getattr(model, 'uri', '')).split('/')
+    return parts[3] if len(parts) > 3 else 'llm'
+
+
+async def run_model(model: Any, messages: Any, priority: int = PRIORITY_SUMMARY) -> Any:
+    """Единая точка вызова completions моделей через планировщик"""
+    return await get_limiter(model_name(model)).call(lambda: model.run(messages), priority)
+
+
+def limiter_stats() -> Dict[str, dict]:
+    return {name: limiter.stats() for name, limiter in _limiters.items()}
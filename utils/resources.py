@@ -0,0 +1,92 @@
+import os
+import pathlib
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from pydantic import BaseModel
+from yandex_cloud_ml_sdk import AsyncYCloudML
+
+from utils.html_extract import shutdown_pool
+from utils.http_client import close_session, get_session
+from utils.retrieval_index import get_index
+
+PROMPTS_DIR = pathlib.Path(__file__).resolve().parent / 'prompts'
+QUESTION_PLACEHOLDER = '{{ question_text }}'
+
+ANSWER_MODEL = 'yandexgpt-lite'
+ANSWER_TEMPERATURE = 0.3
+ANSWER_MAX_TOKENS = 32000
+SUMMARY_TEMPERATURE = 0.3
+SUMMARY_MAX_TOKENS = 4000
+# модель финального ответа, когда ответ lite модели несколько раз не удалось разобрать
+STRONG_MODEL = os.getenv('CASCADE_STRONG_MODEL', 'yandexgpt')
+DIRECT_MAX_TOKENS = 2000
+
+
+class Prompts(BaseModel):
+    """Шаблоны промптов, прочитанные один раз и заранее разрезанные по подстановкам"""
+    base_instructions: str
+    after_search_parts: Tuple[str, ...]
+    direct_answer_parts: Tuple[str, ...]
+
+    def after_search(self, question: str) -> str:
+        return question.join(self.after_search_parts)
+
+    def direct_answer(self, question: str) -> str:
+        return question.join(self.direct_answer_parts)
+
+
+@lru_cache(maxsize=None)
+def load_prompts(directory: str = str(PROMPTS_DIR)) -> Prompts:
+    """
+    Читает промпты относительно пакета, а не рабочей директории.
+    Под gunicorn --preload это происходит один раз в мастере
+    """
+    directory = pathlib.Path(directory)
+    after_search = (directory / 'after_search_instruct.xml').read_text(encoding='utf-8')
+    direct_answer = (directory / 'direct_answer_instruct.xml').read_text(encoding='utf-8')
+    return Prompts(
+        base_instructions=(directory / 'base_instruct.xml').read_text(encoding='utf-8'),
+        after_search_parts=tuple(after_search.split(QUESTION_PLACEHOLDER)),
+        direct_answer_parts=tuple(direct_answer.split(QUESTION_PLACEHOLDER)),
+    )
+
+
+class Resources:
+    """
+    Все, что нужно workflow и живет столько же, сколько воркер: клиент
+    sdk, настроенные модели, пул соединений и промпты. Создается в
+    lifespan приложения и передается в каждый YaGPTResponse
+    """
+
+    def __init__(self, sdk: AsyncYCloudML, search_api_key: str, folder_id: Optional[str] = None,
+                 prompts: Optional[Prompts] = None):
+        self.sdk = sdk
+        self.search_api_key = search_api_key
+        self.folder_id = folder_id or sdk._folder_id
+        self.prompts = prompts or load_prompts()
+
+        models = sdk.models
+        self.answer_model = models.completions(ANSWER_MODEL).configure(temperature=ANSWER_TEMPERATURE,
+                                                                      max_tokens=ANSWER_MAX_TOKENS)
+        self.cleanup_model = models.completions(ANSWER_MODEL)
+        self.summary_model = models.completions(ANSWER_MODEL).configure(temperature=SUMMARY_TEMPERATURE,
+                                                                       max_tokens=SUMMARY_MAX_TOKENS)
+        # каскад: дешевый прямой ответ без поиска и сильная модель для трудных финальных ответов
+        self.direct_model = models.completions(ANSWER_MODEL).configure(temperature=ANSWER_TEMPERATURE,
+                                                                      max_tokens=DIRECT_MAX_TOKENS)
+        self.strong_model = models.completions(STRONG_MODEL).configure(temperature=ANSWER_TEMPERATURE,
+                                                                      max_tokens=ANSWER_MAX_TOKENS)
+
+    async def start(self) -> None:
+        """Прогрев внутри event loop воркера: пул соединений и mmap локального индекса"""
+        get_session()
+        try:
+            get_index()
+        except (OSError, ValueError, KeyError):
+            # битый индекс не должен ронять воркер, workflow сам уйдет в поиск
+            pass
+
+    async def close(self) -> None:
+        await close_session()
+        shutdown_pool()
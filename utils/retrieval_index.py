@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import pathlib
+import re
+import shutil
+import sys
+import time
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import aiohttp
+from pydantic import BaseModel
+
+from utils.html_extract import extract_text
+from utils.http_client import fetch_text
+from utils.questions import split_options
+from utils.terms import tokenize
+
+INDEX_PATH = os.getenv('INDEX_PATH', 'cache/index')
+INDEX_MIN_SCORE = float(os.getenv('INDEX_MIN_SCORE', 0.3))
+INDEX_TOP_K = int(os.getenv('INDEX_TOP_K', 8))
+INDEX_PASSAGE_CHARS = int(os.getenv('INDEX_PASSAGE_CHARS', 600))
+
+K1, B = 1.2, 0.75
+CANONICAL_PATTERN = re.compile(r'<link[^>]+rel=["\']canonical["\'][^>]*href=["\']([^"\']+)', re.I)
+DUMP_SUFFIXES = ('.html', '.htm', '.txt')
+
+
+def split_passages(text: str, size: int = INDEX_PASSAGE_CHARS) -> List[str]:
+    """Режет текст на пассажи около size символов по границам слов с перекрытием в шестую часть"""
+    words = text.split()
+    passages, current, length = [], [], 0
+    for word in words:
+        current.append(word)
+        length += len(word) + 1
+        if length >= size:
+            passages.append(' '.join(current))
+            overlap = []
+            while current and sum(len(kept) + 1 for kept in overlap) < size // 6:
+                overlap.insert(0, current.pop())
+            current, length = overlap, sum(len(kept) + 1 for kept in overlap)
+    if current and (not passages or length > size // 6):
+        passages.append(' '.join(current))
+    return passages
+
+
+class IndexedDocument(BaseModel):
+    source: str
+    url: str
+    digest: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    passages: List[str] = []
+
+
+class Passage(NamedTuple):
+    url: str
+    text: str
+    score: float
+
+
+class RetrievalIndex:
+    """
+    BM25 индекс по пассажам, лежащий на диске: словарь термов в meta.json,
+    постинги (номер пассажа, tf), длины пассажей и сам текст отображаются
+    в память через mmap, поэтому загрузка не читает весь корпус
+    """
+
+    def __init__(self, path: str = INDEX_PATH):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        self.lexicon: Dict[str, List[int]] = meta['lexicon']
+        self.documents: List[dict] = meta['documents']
+        self.size: int = meta['passages']
+        self.avgdl: float = meta['avgdl'] or 1.0
+        self._maps: List[mmap.mmap] = []
+        self._postings = self._map('postings.bin', 'I')
+        self._lengths = self._map('lengths.bin', 'I')
+        self._owners = self._map('owners.bin', 'I')
+        self._offsets = self._map('offsets.bin', 'Q')
+        self._text = self._map('passages.bin', 'B')
+
+    def _map(self, name: str, fmt: str) -> memoryview:
+        with open(os.path.join(self.path, name), 'rb') as data_file:
+            if os.fstat(data_file.fileno()).st_size == 0:
+                return memoryview(b'').cast(fmt)
+            mapped = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return memoryview(mapped).cast(fmt)
+
+    def passage(self, number: int) -> str:
+        return bytes(self._text[self._offsets[number]:self._offsets[number + 1]]).decode('utf-8')
+
+    def document_passages(self, document: dict) -> List[str]:
+        return [self.passage(number) for number in range(document['first'], document['first'] + document['count'])]
+
+    def idf(self, df: int) -> float:
+        return math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = INDEX_TOP_K) -> List[Passage]:
+        """
+        Лучшие пассажи по BM25. Оценка нормирована на максимально возможную
+        для этого вопроса (формулировка плюс один вариант ответа, верный
+        только один), поэтому порог не зависит от длины вопроса
+        """
+        stem, options = split_options(query)
+        stem_terms = set(tokenize(stem))
+        option_terms = [set(tokenize(text)) - stem_terms for _, text in options]
+        weight = {term: self.idf(self.lexicon.get(term, (0, 0))[1]) * (K1 + 1)
+                  for term in stem_terms.union(*option_terms)}
+        best_possible = (sum(weight[term] for term in stem_terms)
+                         + max((sum(weight[term] for term in terms) for terms in option_terms), default=0.0))
+
+        scores: Dict[int, float] = {}
+        for term in weight:
+            offset, df = self.lexicon.get(term, (0, 0))
+            idf = self.idf(df)
+            postings = self._postings[offset * 2:(offset + df) * 2]
+            for index in range(0, len(postings), 2):
+                number, tf = postings[index], postings[index + 1]
+                norm = K1 * (1 - B + B * self._lengths[number] / self.avgdl)
+                scores[number] = scores.get(number, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+        if not scores:
+            return []
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [Passage(self.documents[self._owners[number]]['url'], self.passage(number),
+                        round(min(1.0, score / best_possible), 4))
+                for number, score in best]
+
+    def close(self) -> None:
+        for view in (self._postings, self._lengths, self._owners, self._offsets, self._text):
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+
+
+def write_index(documents: List[IndexedDocument], path: str = INDEX_PATH) -> dict:
+    """
+    Пишет индекс во временную папку и подменяет ею старую: воркеры,
+    которые держат старые файлы через mmap, дочитывают их без ошибок
+    """
+    staging = f'{path}.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    postings: Dict[str, List[int]] = {}
+    lengths, owners, offsets = array('I'), array('I'), array('Q', [0])
+    described = []
+    with open(os.path.join(staging, 'passages.bin'), 'wb') as text_file:
+        for owner, document in enumerate(documents):
+            described.append({**document.model_dump(exclude={'passages'}),
+                              'first': len(lengths), 'count': len(document.passages)})
+            for passage in document.passages:
+                encoded = passage.encode('utf-8')
+                text_file.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+                tokens = tokenize(passage)
+                for term, tf in Counter(tokens).items():
+                    postings.setdefault(term, []).extend((len(lengths), tf))
+                lengths.append(len(tokens))
+                owners.append(owner)
+
+    flat, lexicon = array('I'), {}
+    for term in sorted(postings):
+        lexicon[term] = [len(flat) // 2, len(postings[term]) // 2]
+        flat.extend(postings[term])
+
+    for name, values in (('postings.bin', flat), ('lengths.bin', lengths),
+                         ('owners.bin', owners), ('offsets.bin', offsets)):
+        with open(os.path.join(staging, name), 'wb') as data_file:
+            values.tofile(data_file)
+
+    meta = {
+        'built_at': time.time(),
+        'passages': len(lengths),
+        'avgdl': sum(lengths) / len(lengths) if lengths else 0.0,
+        'documents': described,
+        'lexicon': lexicon,
+    }
+    # meta.json пишется последним: по нему читатели понимают, что индекс готов
+    with open(os.path.join(staging, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+        json.dump(meta, meta_file, ensure_ascii=False)
+
+    previous = f'{path}.old'
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, previous)
+    os.rename(staging, path)
+    shutil.rmtree(previous, ignore_errors=True)
+    return {'documents': len(documents), 'passages': len(lengths), 'terms': len(lexicon)}
+
+
+_loaded: Optional[RetrievalIndex] = None
+_loaded_version: Optional[tuple] = None
+
+
+def get_index(path: str = INDEX_PATH) -> Optional[RetrievalIndex]:
+    """
+    Индекс воркера, None если он не собран. После refresh папка подменяется,
+    и следующий вызов сам откроет новую версию, а прежнюю закроет: иначе
+    mmap удаленных файлов старого индекса живут до конца воркера. search
+    синхронный и отдает готовые строки, поэтому старый индекс в этот
+    момент никем не читается
+    """
+    global _loaded, _loaded_version
+    if not path:
+        return None
+    try:
+        version = (path, os.stat(os.path.join(path, 'meta.json')).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    if version != _loaded_version:
+        previous = _loaded
+        _loaded, _loaded_version = RetrievalIndex(path), version
+        if previous is not None:
+            previous.close()
+    return _loaded
+
+
+def digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+async def ingest_url(url: str, previous: Optional[IndexedDocument]) -> Optional[IndexedDocument]:
+    """Скачивает страницу, неизменившиеся (304 или тот же текст) и недоступные берутся из прошлой версии"""
+    headers = {}
+    if previous is not None:
+        if previous.etag:
+            headers['If-None-Match'] = previous.etag
+        if previous.last_modified:
+            headers['If-Modified-Since'] = previous.last_modified
+    try:
+        status, response_headers, content = await fetch_text(url, headers)
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        return previous
+    if status == 304 or not content:
+        return previous
+
+    text = await extract_text(content)
+    if previous is not None and previous.digest == digest(text):
+        return previous
+    return IndexedDocument(source=url, url=url, digest=digest(text), etag=response_headers.get('ETag'),
+                           last_modified=response_headers.get('Last-Modified'), passages=split_passages(text))
+
+
+async def ingest_file(path: str, previous: Optional[IndexedDocument]) -> Optional[IndexedDocument]:
+    """Документ из локального дампа: url берется из <link rel="canonical">, иначе file://"""
+    try:
+        raw = pathlib.Path(path).read_text(encoding='utf-8', errors='replace')
+    except OSError:
+        return previous
+    if previous is not None and previous.digest == digest(raw):
+        return previous
+
+    canonical = CANONICAL_PATTERN.search(raw)
+    url = canonical.group(1) if canonical else pathlib.Path(path).resolve().as_uri()
+    text = await extract_text(raw) if path.endswith(('.html', '.htm')) else raw.lower()
+    return IndexedDocument(source=path, url=url, digest=digest(raw), passages=split_passages(text))
+
+
+def dump_files(directory: str) -> List[str]:
+    return sorted(str(file) for file in pathlib.Path(directory).rglob('*') if file.suffix in DUMP_SUFFIXES)
+
+
+def previous_documents(path: str) -> Dict[str, IndexedDocument]:
+    index = get_index(path)
+    if index is None:
+        return {}
+    return {document['source']: IndexedDocument(**document, passages=index.document_passages(document))
+            for document in index.documents}
+
+
+async def build(sources: Iterable[str], path: str = INDEX_PATH, incremental: bool = True,
+                concurrency: int = 8) -> dict:
+    """
+    Собирает индекс из url и файлов. При incremental к переданным источникам
+    добавляются уже проиндексированные, а неизменившиеся документы
+    переиспользуются без повторного разбиения
+    """
+    from utils.html_extract import shutdown_pool
+    from utils.http_client import close_session
+
+    previous = previous_documents(path) if incremental else {}
+    sources = list(dict.fromkeys(list(previous) + list(sources)))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def ingest(source: str) -> Optional[IndexedDocument]:
+        async with semaphore:
+            if source.startswith(('http://', 'https://')):
+                return await ingest_url(source, previous.get(source))
+            return await ingest_file(source, previous.get(source))
+
+    try:
+        documents = [document for document in await asyncio.gather(*map(ingest, sources)) if document]
+    finally:
+        await close_session()
+        shutdown_pool()
+    stats = write_index(documents, path)
+    stats['reused'] = sum(1 for document in documents if previous.get(document.source) is document)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m utils.retrieval_index')
+    parser.add_argument('command', choices=('build', 'refresh', 'query'))
+    parser.add_argument('--urls', help='файл со списком url, по одному на строку')
+    parser.add_argument('--dump', help='папка с сохраненными .html / .txt документами')
+    parser.add_argument('--path', default=INDEX_PATH)
+    parser.add_argument('--top-k', type=int, default=INDEX_TOP_K)
+    parser.add_argument('text', nargs='?', help='вопрос для query')
+    args = parser.parse_args()
+
+    if args.command == 'query':
+        index = get_index(args.path)
+        if index is None or not args.text:
+            print('usage: python -m utils.retrieval_index query "<вопрос>" (индекс должен быть собран)')
+            sys.exit(1)
+        for passage in index.search(args.text, args.top_k):
+            print(f'{passage.score:.3f} {passage.url}\n    {passage.text[:200]}')
+        return
+
+    sources = []
+    if args.urls:
+        with open(args.urls) as url_file:
+            sources += [line.strip() for line in url_file if line.strip() and not line.startswith('#')]
+    if args.dump:
+        sources += dump_files(args.dump)
+    if args.command == 'build' and not sources:
+        print('nothing to index: pass --urls and/or --dump')
+        sys.exit(1)
+    stats = asyncio.run(build(sources, args.path, incremental=args.command == 'refresh'))
+    print(f"indexed {stats['documents']} documents ({stats['reused']} unchanged), "
+          f"{stats['passages']} passages, {stats['terms']} terms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,134 @@
+import asyncio
+import os
+import random
 import xml.etree.ElementTree as ET
-from typing import List
+from typing import List, Optional, Set, Tuple
+from urllib.parse import urlsplit
 
-import requests
+import aiohttp
 
+from utils.exceptions import LLMWorkflowError, ThrottledError
+from utils.http_client import get_session, CHUNK_SIZE
+from utils.metrics import SOURCES_DROPPED
+from utils.rate_limit import get_limiter, PRIORITY_QUERY
 
-def perform_search(query: str, folder_id: str, api_key: str) -> str:
+SEARCH_URL = os.getenv('YA_SEARCH_URL', 'https://yandex.ru/search/xml')
+SEARCH_CONNECT_TIMEOUT = float(os.getenv('SEARCH_CONNECT_TIMEOUT', 3))
+SEARCH_TOTAL_TIMEOUT = float(os.getenv('SEARCH_TOTAL_TIMEOUT', 10))
+# повторы при сетевых ошибках и 5xx; 429 повторяет планировщик search
+SEARCH_RETRIES = int(os.getenv('SEARCH_RETRIES', 2))
+SEARCH_BACKOFF = float(os.getenv('SEARCH_BACKOFF', 0.5))
+# сколько ссылок дочитывать из выдачи, дальше xml не разбирается
+SEARCH_MAX_URLS = int(os.getenv('SEARCH_MAX_URLS', 10))
+
+HTML_MIME_TYPES = ('text/html', 'application/xhtml+xml')
+NOT_HTML_EXTENSIONS = ('.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.rtf', '.odt',
+                       '.zip', '.rar', '.7z', '.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mp3')
+
+
+def url_key(url: str) -> Tuple[str, str, str]:
+    """
+    Хост без www, путь без завершающего слэша и query: одна страница по
+    http/https и с разными якорями. Query остается, ?id=1 и ?id=2 - разные страницы
+    """
+    parts = urlsplit(url)
+    host = parts.hostname or ''
+    if host.startswith('www.'):
+        host = host[4:]
+    return host, parts.path.rstrip('/') or '/', parts.query
+
+
+def is_html(url: str, mime_type: Optional[str]) -> bool:
+    if mime_type:
+        return mime_type.split(';')[0].strip().lower() in HTML_MIME_TYPES
+    return not urlsplit(url).path.lower().endswith(NOT_HTML_EXTENSIONS)
+
+
+class SearchParser:
     """
-    Создает простой get запрос на api yandex search,
-    возвращает строку, которая является xml деревом
+    Инкрементальный разбор xml выдачи по мере скачивания: каждый <doc>
+    обрабатывается, как только закрылся, дубликаты по url_key и не
+    html документы (pdf, офисные файлы) отбрасываются. Разбор
+    останавливается, когда набрано max_urls ссылок
     """
-    base_url = "https://yandex.ru/search/xml?sortby=rlv&filter=strict"
-    auth_url = f"{base_url}&folderid={folder_id}&apikey={api_key}"
 
-    response = requests.get(f'{auth_url}&query={query}')
-    return response.text if response.status_code == 200 else ''
+    def __init__(self, max_urls: int = SEARCH_MAX_URLS):
+        self.max_urls = max_urls
+        self.urls: List[str] = []
+        self._seen: Set[Tuple[str, str, str]] = set()
+        self._parser = ET.XMLPullParser(events=('end',))
+
+    @property
+    def done(self) -> bool:
+        return len(self.urls) >= self.max_urls
+
+    def feed(self, data: bytes) -> bool:
+        """Скармливает очередной кусок ответа, возвращает True, когда ссылок достаточно"""
+        self._parser.feed(data)
+        for _, element in self._parser.read_events():
+            if element.tag != 'doc' or self.done:
+                continue
+            self._add((element.findtext('url') or '').strip(), element.findtext('mime-type'))
+            element.clear()
+        return self.done
+
+    def _add(self, url: str, mime_type: Optional[str]) -> None:
+        if not url.startswith(('http://', 'https://')):
+            return
+        if not is_html(url, mime_type):
+            SOURCES_DROPPED.inc(reason='not_html')
+            return
+        key = url_key(url)
+        if key in self._seen:
+            SOURCES_DROPPED.inc(reason='duplicate')
+            return
+        self._seen.add(key)
+        self.urls.append(url)
 
 
-def parse_search(response_text: str) -> List[str]:
-    """Парсит xml дерево и возвращает ссылки на ресурсы с 1 страницы поиска"""
-    if not response_text:
-        return ['']
-    root = ET.fromstring(response_text)
-    urls = []
-    for elem in root.findall(".//doc/*") + root.findall(".//properties/*"):
-        if elem.tag == "url":
-            urls.append(elem.text.strip())
+async def perform_search(query: str, folder_id: str, api_key: str, max_urls: int = SEARCH_MAX_URLS) -> List[str]:
+    """
+    Запрос к api yandex search через общий пул соединений воркера.
+    Ответ разбирается потоково, дочитывается только до max_urls ссылок
+    """
+    params = {
+        'sortby': 'rlv',
+        'filter': 'strict',
+        'folderid': folder_id,
+        'apikey': api_key,
+        'query': query,
+    }
+    timeout = aiohttp.ClientTimeout(total=SEARCH_TOTAL_TIMEOUT, sock_connect=SEARCH_CONNECT_TIMEOUT)
+    async with get_session().get(SEARCH_URL, params=params, timeout=timeout) as response:
+        if response.status == 429:
+            raise ThrottledError('Yandex search API returned 429')
+        if response.status >= 500:
+            response.raise_for_status()
+        if response.status != 200:
+            return []
 
-    return urls
+        parser = SearchParser(max_urls)
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if parser.feed(chunk):
+                    break
+        except ET.ParseError:
+            # битый хвост ответа: отдаем то, что успели разобрать
+            pass
+        return parser.urls
 
 
-def get_search_urls(query: str, folder_id: str, api_key: str) -> List[str]:
-    """Простой интерфейс для получения первых ссылок результата поиска яндекса"""
-    return parse_search(perform_search(query, folder_id, api_key))
+async def get_search_urls(query: str, folder_id: str, api_key: str) -> List[str]:
+    """
+    Простой интерфейс для получения первых ссылок результата поиска яндекса.
+    Сетевые ошибки и 5xx повторяются с экспоненциальной задержкой
+    """
+    for attempt in range(SEARCH_RETRIES + 1):
+        try:
+            return await get_limiter('search').call(lambda: perform_search(query, folder_id, api_key),
+                                                    PRIORITY_QUERY)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == SEARCH_RETRIES:
+                raise LLMWorkflowError(f'Yandex search is unavailable: {e!r}')
+        await asyncio.sleep(SEARCH_BACKOFF * 2 ** attempt * (1 + random.random()))
+    return []
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Склеивает одновременные вычисления с одинаковым ключом: первый запрос
+    запускает задачу, остальные ждут ее же результат.
+
+    Задача живет отдельно от запросов, поэтому отмена или таймаут лидера
+    не роняет остальных ожидающих. Если ждать больше некому, задача
+    отменяется, чтобы не тратить квоту api впустую. Ошибка задачи получают
+    все ожидающие, а ключ освобождается для следующей попытки
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(factory()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self._calls[key] = call
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._calls),
+            'started': self.started,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,43 @@
+import json
+import os
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+# комментарий-пинг, чтобы прокси не закрывали соединение во время долгих стадий
+SSE_PING_INTERVAL = float(os.getenv('SSE_PING_INTERVAL', 15))
+SSE_MEDIA_TYPE = 'text/event-stream'
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+PING = ': ping\n\n'
+
+
+def wants_stream(accept: str) -> bool:
+    return SSE_MEDIA_TYPE in accept.lower()
+
+
+def format_event(event: str, data: Any) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def stage_event(stage: str, result: Any) -> Optional[Tuple[str, Any]]:
+    """
+    Событие для клиента по результату стадии YaGPTResponse: поисковый
+    запрос, выбранные ссылки и выжимки источников. Финальный ответ
+    отправляется отдельно, остальные стадии клиенту не интересны
+    """
+    if stage == 'query':
+        return 'query', {'query': result}
+    if stage == 'search':
+        return 'sources', {'urls': result, 'local': False}
+    if stage == 'local':
+        return 'sources', {'urls': list(result), 'local': True}
+    if stage == 'summary':
+        return 'summary', result
+    return None
+
+
+async def wait_disconnect(receive: Callable[[], Awaitable[dict]]) -> None:
+    """
+    Возвращается, когда клиент закрыл соединение. Тело запроса к этому
+    моменту уже прочитано, поэтому receive отдаст только http.disconnect
+    """
+    while (await receive())['type'] != 'http.disconnect':
+        pass
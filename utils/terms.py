@@ -0,0 +1,20 @@
+import re
+from typing import List
+
+# вопросительные и служебные слова, которые встречаются на любой странице
+STOP_WORDS = {
+    'какой', 'какая', 'какое', 'какие', 'каком', 'какого', 'каких', 'сколько', 'когда', 'где',
+    'который', 'которые', 'является', 'следующих', 'сейчас', 'называется', 'университет',
+    'университета', 'университете', 'итмо', 'itmo',
+}
+TOKEN_PATTERN = re.compile(r'\w{2,}')
+
+
+def stem(word: str) -> str:
+    """Грубый стемминг: отрезает окончание, чтобы ловить другие падежи ("кампуса" -> "кампу")"""
+    return word[:max(5, len(word) - 2)]
+
+
+def tokenize(text: str) -> List[str]:
+    """Слова текста в нижнем регистре без служебных, с отрезанными окончаниями"""
+    return [stem(word) for word in TOKEN_PATTERN.findall(text.lower()) if word not in STOP_WORDS]